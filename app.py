@@ -1,40 +1,207 @@
-import base64
 import os
+import time
 
 import streamlit as st
 
-from controls import display_audio
-from utils import (
-    download_from_yt,
-    get_file_path,
-    install_ffmpeg_from_url,
-    lock_exists,
-    lock_file,
-    lock_remove,
-    read_version,
-    separate_tracks,
+from catalogue import PAGE_SIZE, Catalogue
+from controls import STEMS_EMOJIS, display_audio
+from encoder import FORMATS, StemEncoder
+from ingest import DOWNLOAD_FAILED, DOWNLOADED, YouTubeIngester
+from input_store import DECODE_UPLOADS, MAX_UPLOAD_BYTES, InputStore
+from jobs import (
+    ACTIVE_STATES,
+    FAILED,
+    FULL_PRIORITY,
+    POLL_INTERVAL_IN_SECONDS,
+    PREVIEW_PRIORITY,
+    RUNNING,
+    JobQueue,
+    start_workers,
 )
+from mixdown import PRESETS, Mixer, preset_gains
+from pcm_cache import CHANNELS, SAMPLERATE, PcmCache
+from peaks import read_peaks
+from preview import PREVIEW_SECONDS, preview_model
+from profiles import (
+    DEFAULT_PROFILE,
+    INFERENCE_PROFILES,
+    RESIDUAL_STEM,
+    output_stems,
+    store_model,
+)
+from profiling import read_profile
+from stem_cache import stem_cache
+from stem_server import start_stem_server, stem_url
+from stem_store import OUTPUT_BITRATE, OUTPUT_FORMAT, StemStore
+from utils import find_ffmpeg, provision_ffmpeg, read_version
 
 AUDIO_DIR = "inputs"
 OUTPUT_PATH = "separated"
 
 
 @st.cache_resource
-def get_audio_base64(file_path):
-    with open(file_path, "rb") as f:
-        data = f.read()
-        return base64.b64encode(data).decode()
+def get_job_queue():
+    # one queue and worker pool per server process, shared by all sessions.
+    # Workers find ffmpeg themselves when they get their first job
+    job_queue = JobQueue()
+    start_workers(output_path=OUTPUT_PATH)
+    return job_queue
+
+
+@st.cache_resource
+def get_ingester():
+    # downloads requested with a model are queued for separation as soon as
+    # they complete
+    job_queue = get_job_queue()
+    return YouTubeIngester(
+        input_dir=AUDIO_DIR,
+        on_download=lambda song, file_path, model: job_queue.submit(
+            song=song, model=model, file_path=file_path, priority=FULL_PRIORITY
+        ),
+    )
+
+
+@st.cache_resource
+def get_stem_store():
+    return StemStore(OUTPUT_PATH)
+
+
+@st.cache_resource
+def get_catalogue():
+    # one per server, synced with AUDIO_DIR on the reruns following a change
+    # to it, see Catalogue.refresh
+    return Catalogue(AUDIO_DIR, get_stem_store())
+
+
+@st.cache_resource
+def get_input_store():
+    pcm_cache = PcmCache(os.path.join(OUTPUT_PATH, "pcm")) if DECODE_UPLOADS else None
+    return InputStore(AUDIO_DIR, get_stem_store(), pcm_cache)
+
+
+@st.cache_resource
+def get_stem_encoder():
+    return StemEncoder(get_stem_store())
+
+
+@st.cache_resource
+def get_stem_server():
+    return start_stem_server(
+        root=OUTPUT_PATH, encoder=get_stem_encoder(), job_queue=get_job_queue()
+    )
+
+
+def show_job_progress(job):
+    if job["status"] != RUNNING:
+        st.info("Waiting for a worker to split the tracks...")
+        return
+    progress = job["progress"]
+    elapsed_time = time.time() - job["started_at"]
+    remaining_time = elapsed_time * (1 - progress) / progress if progress else 0
+    st.progress(int(progress * 100))
+    st.text(
+        f"Progress: {progress:.0%} | Elapsed: {elapsed_time:.2f}s | Remaining: {remaining_time:.2f}s"
+    )
+
+
+@st.fragment(run_every=POLL_INTERVAL_IN_SECONDS)
+def poll_job(job_id):
+    # only this fragment is rerun while the job is active, so that the
+    # preview keeps playing, then the whole page
+    job = get_job_queue().get(job_id)
+    if job["status"] in ACTIVE_STATES:
+        show_job_progress(job)
+    else:
+        st.rerun()
+
+
+def choose_song(label, current, key, allow_none=False):
+    catalogue = get_catalogue()
+    catalogue.refresh()
+    query = st.text_input("Search songs", key=f"{key}_query")
+    pages = max(-(-catalogue.count(query) // PAGE_SIZE), 1)
+    page = 1
+    if pages > 1:
+        page = st.number_input(
+            "Page", min_value=1, max_value=pages, value=1, key=f"{key}_page"
+        )
+    songs = {
+        song["name"]: song
+        for song in catalogue.search(query, offset=(page - 1) * PAGE_SIZE)
+    }
+    options = list(songs)
+    if current and current not in songs:
+        options.insert(0, current)
+    if allow_none:
+        options.insert(0, "")
 
+    def describe(name):
+        song = songs.get(name)
+        if song is None:
+            return name
+        details = []
+        if song["duration"]:
+            minutes, seconds = divmod(int(song["duration"]), 60)
+            details.append(f"{minutes}:{seconds:02d}")
+        if song["models"]:
+            details.append("split with " + ", ".join(song["models"]))
+        return f"{name} ({' | '.join(details)})" if details else name
 
-def save_uploaded_file(uploaded_file, save_dir=AUDIO_DIR):
-    file_name = uploaded_file.name
-    save_path = os.path.join(save_dir, file_name)
-    if os.path.exists(save_path):
-        return save_path
-    os.makedirs(save_dir, exist_ok=True)
-    with open(save_path, "wb") as f:
-        f.write(uploaded_file.read())
-    return save_path
+    return st.selectbox(
+        label,
+        options,
+        key=key,
+        index=options.index(current) if current in options else 0,
+        format_func=describe,
+    )
+
+
+def mixdown(song, audio_hash, model, stems, peaks=None):
+    with st.expander("Mixdown"):
+        preset = st.selectbox("Preset", options=["Custom"] + list(PRESETS))
+        defaults = (
+            preset_gains(preset, stems)
+            if preset != "Custom"
+            else {stem: 1.0 for stem in stems}
+        )
+        gains = {
+            stem: st.slider(
+                f"{STEMS_EMOJIS[stem]} {stem.capitalize()}",
+                min_value=0.0,
+                max_value=1.0,
+                value=defaults[stem],
+                step=0.05,
+                key=f"mix_{preset}_{stem}",
+            )
+            for stem in stems
+        }
+        if peaks:
+            duration = peaks["duration"]
+        else:
+            stem_path = get_stem_store().lookup(audio_hash, model)[stems[0]]
+            # 4 bytes per float32 sample
+            duration = os.path.getsize(stem_path) / (4 * CHANNELS * SAMPLERATE)
+        start, end = st.slider(
+            "Region (seconds)",
+            min_value=0.0,
+            max_value=float(duration),
+            value=(0.0, float(duration)),
+        )
+        if st.button("Render mix"):
+            with st.spinner("Mixing..."):
+                mix_path = Mixer(get_stem_store()).render(
+                    audio_hash,
+                    model,
+                    gains,
+                    start=start,
+                    end=None if end >= duration else end,
+                )
+            st.download_button(
+                label="Download mix",
+                data=stem_cache.read(mix_path),
+                file_name=f"{song} - mix.mp3",
+                mime="audio/mpeg",
+            )
 
 
 def footer():
@@ -85,12 +252,22 @@ MODELS = {
     },
 }
 
+PROFILES = {
+    "full": "Full precision",
+    "bf16": "bfloat16",
+    "int8": "int8 quantized",
+    "fast": "Fast (bfloat16, no shifts, less overlap)",
+}
+
 
 def main():
     st.title("Audio Track Splitter")
-    ffmpeg_path = os.path.dirname(install_ffmpeg_from_url())
-    print(ffmpeg_path)
-    st.session_state["ffmpeg_path"] = ffmpeg_path
+    # the page doesn't wait for ffmpeg, it is only needed to split and encode
+    if find_ffmpeg() is None:
+        provision_ffmpeg()
+    job_queue = get_job_queue()
+    stem_store = get_stem_store()
+    get_stem_server()
     model = st.selectbox(
         label="Choose a Demucs model",
         options=list(MODELS.keys()),
@@ -98,42 +275,85 @@ def main():
         + f' ({", ".join(MODELS[model]["stems"])})',
     )
     stems = MODELS[model]["stems"]
+    profile = st.selectbox(
+        label="Quality",
+        options=list(INFERENCE_PROFILES),
+        index=list(INFERENCE_PROFILES).index(DEFAULT_PROFILE),
+        format_func=lambda profile: PROFILES[profile],
+    )
+    kept_stems = st.multiselect(
+        "Stems",
+        options=stems,
+        default=stems,
+        help=f"The stems left out are only written mixed together, as {RESIDUAL_STEM}",
+    )
+    subset = kept_stems if kept_stems and set(kept_stems) != set(stems) else None
+    # stems of each profile and subset are stored apart
+    stored_model = store_model(model, profile, subset)
+    stems = output_stems(stems, subset)
     if "song" not in st.session_state:
         st.session_state["song"] = ""
     song = st.session_state.get("song", "")
 
     if not st.session_state["song"]:
-        file_upload = st.file_uploader("Choose your own song!")
+        file_upload = st.file_uploader(
+            "Choose your own song!",
+            help=f"Up to {MAX_UPLOAD_BYTES // 1024**2} MB",
+        )
         yt_song = st.text_input("Enter YouTube link:")
         st.text(
             body="ℹ️ Double tap outside the input box after pasting the link if using your phone."
         )
+        split_when_downloaded = st.checkbox("Split the tracks once downloaded")
         if yt_song:
-            try:
-                downloaded_song = download_from_yt(yt_song, input_dir=AUDIO_DIR)
-                if downloaded_song:
-                    st.session_state["song"] = (
-                        downloaded_song  # Set downloaded song as default
-                    )
-                    st.success("Download complete!")
-            except Exception:
+            ingester = get_ingester()
+            video = ingester.submit(
+                yt_song, model=model if split_when_downloaded else None
+            )
+            download = ingester.get(video) if video else None
+            if download is None:
+                st.error("This is not a YouTube link.")
+            elif download["status"] == DOWNLOADED:
+                get_catalogue().add(ingester.file_path(download))
+                # Set downloaded song as default
+                st.session_state["song"] = download["file_name"]
+                st.success("Download complete!")
+            elif download["status"] == DOWNLOAD_FAILED:
                 st.error("Failed to download the song.")
+                if st.button("Retry download"):
+                    ingester.submit(
+                        yt_song,
+                        model=model if split_when_downloaded else None,
+                        retry=True,
+                    )
+                    st.rerun()
+            else:
+                st.info("Downloading...")
+                time.sleep(POLL_INTERVAL_IN_SECONDS)
+                st.rerun()
 
         if file_upload is not None:
-            st.session_state["song"] = file_upload.name  # Set uploaded file as default
-            save_uploaded_file(file_upload, save_dir=AUDIO_DIR)
+            # the uploader keeps its file across reruns, save it only once
+            uploads = st.session_state.setdefault("uploads", {})
+            if file_upload.file_id not in uploads:
+                try:
+                    with st.spinner("Saving..."):
+                        file_path = get_input_store().save(
+                            file_upload, file_upload.name
+                        )
+                        get_catalogue().add(file_path)
+                    uploads[file_upload.file_id] = os.path.basename(file_path)
+                except ValueError as e:
+                    st.error(str(e))
+            if file_upload.file_id in uploads:
+                # Set uploaded file as default
+                st.session_state["song"] = uploads[file_upload.file_id]
 
-        songs = [path for path in os.listdir(AUDIO_DIR) if not path.startswith(".")]
-        songs = [""] + songs
-        if st.session_state["song"] in songs:
-            index = songs.index(st.session_state["song"])
-        else:
-            index = 0
-        st.session_state["song"] = st.selectbox(
+        st.session_state["song"] = choose_song(
             "Or choose a preloaded audio track",
-            songs,
+            current=st.session_state["song"],
             key="audio1",
-            index=index,
+            allow_none=True,
         )
         if st.session_state["song"]:
             st.rerun()
@@ -141,57 +361,124 @@ def main():
         if st.button("Go back"):
             st.session_state["song"] = ""
             st.rerun()
-        songs = [path for path in os.listdir(AUDIO_DIR) if not path.startswith(".")]
-        st.session_state["song"] = st.selectbox(
+        st.session_state["song"] = choose_song(
             "Choose a preloaded audio track",
-            songs,
+            current=st.session_state["song"],
             key="audio1",
-            index=songs.index(st.session_state["song"]),
         )
         st.header(st.session_state["song"])
-        loaded_stems = dict()
-        try:
-            for stem in stems:
-                loaded_stems[stem] = get_audio_base64(
-                    get_file_path(song=st.session_state["song"], stem=stem, model=model)
+        file_path = os.path.join(AUDIO_DIR, st.session_state["song"])
+        audio_hash = stem_store.hash_song(file_path)
+        # songs synced from the directory are only hashed once opened
+        get_catalogue().add(file_path, audio_hash)
+        exists = stem_store.lookup(audio_hash, stored_model) is not None
+        # the preview of the song is played until its full stems are there
+        player_model = stored_model if exists else preview_model(stored_model)
+        playable = exists or stem_store.lookup(audio_hash, player_model) is not None
+        if playable:
+            # the player's format is encoded by the stem server on first request
+            stem_urls = {
+                stem: stem_url(
+                    stem_store.stem_path(
+                        audio_hash, player_model, stem, OUTPUT_FORMAT, OUTPUT_BITRATE
+                    ),
+                    root=OUTPUT_PATH,
                 )
-            exists = True
-        except Exception:
-            exists = False
-            file_path = os.path.join(AUDIO_DIR, st.session_state["song"])
-            audio_placeholder = st.empty()
-            audio_placeholder.audio(file_path)
-            split_button_placeholder = st.empty()
-            if split_button_placeholder.button(
-                "Split tracks", key="split_button_placeholder"
-            ):
-                if not lock_exists():
-                    lock_file()
-                    separate_tracks(
-                        file_path=file_path,
-                        output_path=OUTPUT_PATH,
-                        ffmpeg_path=st.session_state["ffmpeg_path"],
+                for stem in stems
+            }
+        if not exists:
+            job = job_queue.find(
+                song=st.session_state["song"],
+                model=model,
+                profile=profile,
+                stems=subset,
+            )
+            if job and job["status"] in ACTIVE_STATES:
+                if playable:
+                    st.info(
+                        f"Playing a {PREVIEW_SECONDS}s preview while the whole song is split."
+                    )
+                    poll_job(job["id"])
+                else:
+                    preview_job = job_queue.find(
+                        song=st.session_state["song"],
                         model=model,
+                        profile=profile,
+                        preview=True,
+                        stems=subset,
                     )
-                    lock_remove()
-                    exists = True
-                    audio_placeholder.empty()
-                    split_button_placeholder.empty()
+                    if preview_job and preview_job["status"] in ACTIVE_STATES:
+                        job = preview_job
+                    show_job_progress(job)
+                    time.sleep(POLL_INTERVAL_IN_SECONDS)
                     st.rerun()
-                else:
-                    st.warning("Please wait a moment before trying again.")
+            else:
+                if job and job["status"] == FAILED:
+                    st.error("Failed to split the tracks, please try again.")
+                st.audio(file_path)
+                profiling = st.checkbox(
+                    "Profile the split",
+                    help="Saves where the time goes next to the stems, slower.",
+                )
+                if st.button("Split tracks", key="split_button_placeholder"):
+                    # a short excerpt first, to be heard right away, then the
+                    # whole song
+                    for priority, preview in (
+                        (PREVIEW_PRIORITY, True),
+                        (FULL_PRIORITY, False),
+                    ):
+                        job_queue.submit(
+                            song=st.session_state["song"],
+                            model=model,
+                            file_path=file_path,
+                            profile=profile,
+                            priority=priority,
+                            preview=preview,
+                            stems=subset,
+                            profiling=profiling and not preview,
+                        )
+                    st.rerun()
+        if playable:
+            peaks = read_peaks(stem_store.stem_dir(audio_hash, player_model))
+            display_audio(song=song, stems=stem_urls, model=model, peaks=peaks)
         if exists:
-            display_audio(song=song, stems=loaded_stems, model=model)
             stem_to_download = st.selectbox(
                 "Download", options=[""] + stems, key="download"
             )
+            output_format = st.selectbox("Format", options=list(FORMATS))
+            bitrate = st.selectbox(
+                "Bitrate (kbps)",
+                options=FORMATS[output_format]["bitrates"],
+                format_func=lambda bitrate: str(bitrate) if bitrate else "lossless",
+            )
             if stem_to_download:
+                with st.spinner("Encoding..."):
+                    download_path = get_stem_encoder().encode(
+                        audio_hash,
+                        stored_model,
+                        stem_to_download,
+                        output_format,
+                        bitrate,
+                    )
                 st.download_button(
                     label="Download",
-                    data=loaded_stems[stem_to_download],
-                    file_name=f"{song} - {stem_to_download}.mp3",
-                    mime="audio/mp3",
+                    data=stem_cache.read(download_path),
+                    file_name=f"{song} - {stem_to_download}.{output_format}",
+                    mime=FORMATS[output_format]["mime"],
                 )
+            mixdown(
+                song=song,
+                audio_hash=audio_hash,
+                model=stored_model,
+                stems=stems,
+                peaks=peaks,
+            )
+            summary = read_profile(stem_store.stem_dir(audio_hash, stored_model))
+            if summary:
+                with st.expander("Profile"):
+                    st.caption(f"Split profiled over {summary['total_seconds']:.1f}s")
+                    st.dataframe(summary["functions"])
+                    st.dataframe(summary["operators"])
 
     footer()
 
@@ -0,0 +1,201 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+from demucs.audio import save_audio
+
+from encoder import encode_pcm
+from engine import PARALLEL_WORKERS, THREADS_PER_WORKER, get_engine
+from stem_store import OUTPUT_BITRATE, OUTPUT_FORMAT, StemStore
+from utils import read_version, separate_tracks
+
+MODELS = ["htdemucs", "htdemucs_6s"]
+DURATIONS_IN_SECONDS = [10, 60, 300]
+SAMPLERATE = 44100
+# a case is a regression when it is this much slower than the baseline
+REGRESSION_THRESHOLD = 1.10
+
+
+def synthetic_song(file_path: str, duration: float, seed=0):
+    # a few tones over a noise floor with a kick every half second,
+    # enough for every stem of the models to have something to separate
+    generator = torch.Generator().manual_seed(seed)
+    t = torch.arange(int(duration * SAMPLERATE)) / SAMPLERATE
+    wav = sum(
+        0.1 * torch.sin(2 * math.pi * frequency * t)
+        for frequency in (55.0, 220.0, 330.0, 440.0, 880.0)
+    )
+    wav = wav + 0.3 * torch.exp(-30 * (t % 0.5)) * torch.sin(2 * math.pi * 60 * t)
+    wav = wav + 0.02 * torch.randn(t.shape, generator=generator)
+    save_audio(torch.stack([wav, wav.roll(100)]), file_path, samplerate=SAMPLERATE)
+
+
+def cpu_usage() -> float:
+    # user + system time of this process and of its ffmpeg children
+    return sum(
+        usage.ru_utime + usage.ru_stime
+        for usage in (
+            resource.getrusage(resource.RUSAGE_SELF),
+            resource.getrusage(resource.RUSAGE_CHILDREN),
+        )
+    )
+
+
+def run_case(
+    file_path, duration, model, ffmpeg_path, workers, threads, segment_threads
+):
+    # runs in its own process so that peak RSS is per case. threads is the
+    # torch threads of the separation, torch's default (as in the app's
+    # workers) if 0, segment_threads those of each parallel segment worker
+    if threads:
+        torch.set_num_threads(threads)
+    engine = get_engine()
+    engine.workers = workers
+    engine.threads_per_worker = segment_threads
+    engine.timings = {}
+    engine.get_model(model)
+    model_load_time = engine.timings.get("model_load", 0.0)
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as output_path:
+        usage_before = cpu_usage()
+        start_time = time.perf_counter()
+        separate_tracks(
+            file_path=file_path,
+            output_path=output_path,
+            ffmpeg_path=ffmpeg_path,
+            model=model,
+        )
+        wall_time = time.perf_counter() - start_time
+        cpu_time = cpu_usage() - usage_before
+        # delivery encoding is lazy in the app, time it for every stem here
+        store = StemStore(output_path)
+        audio_hash = store.hash_song(file_path)
+        with engine.timed("encode"):
+            for stem in store.lookup(audio_hash, model):
+                encode_pcm(
+                    store.stem_path(audio_hash, model, stem),
+                    store.stem_path(
+                        audio_hash, model, stem, OUTPUT_FORMAT, OUTPUT_BITRATE
+                    ),
+                    OUTPUT_FORMAT,
+                    OUTPUT_BITRATE,
+                )
+        return {
+            "model": model,
+            "duration": duration,
+            "workers": engine.workers,
+            "threads": torch.get_num_threads(),
+            "threads_per_worker": engine.threads_per_worker,
+            "wall_time": wall_time,
+            "real_time_factor": wall_time / duration,
+            "cpu_utilisation": cpu_time / wall_time,
+            # ru_maxrss is in KiB on Linux
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "model_load_time": model_load_time,
+            "stage_times": dict(engine.timings),
+        }
+
+
+def compare(results: list, baseline: list) -> list:
+    baseline_times = {
+        (case["model"], case["duration"], case["workers"]): case["wall_time"]
+        for case in baseline
+    }
+    regressions = []
+    for case in results:
+        key = (case["model"], case["duration"], case["workers"])
+        if key not in baseline_times:
+            continue
+        ratio = case["wall_time"] / baseline_times[key]
+        print(f"{case['model']:>12} {case['duration']:>6}s  {ratio:.2f}x baseline")
+        if ratio > REGRESSION_THRESHOLD:
+            regressions.append(case)
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark separation throughput, latency and memory."
+    )
+    parser.add_argument("--models", nargs="+", default=MODELS)
+    parser.add_argument(
+        "--durations", nargs="+", type=float, default=DURATIONS_IN_SECONDS
+    )
+    parser.add_argument("--workers", type=int, default=PARALLEL_WORKERS)
+    parser.add_argument(
+        "--threads", type=int, default=0, help="torch threads, torch's default if 0"
+    )
+    parser.add_argument(
+        "--segment-threads",
+        type=int,
+        default=THREADS_PER_WORKER,
+        help="torch threads of each parallel segment worker",
+    )
+    parser.add_argument("--ffmpeg-path")
+    parser.add_argument("-o", "--output", default="benchmark.json")
+    parser.add_argument("--baseline", help="results of a previous run to compare to")
+    return parser.parse_args(argv)
+
+
+def run_cases(args, input_dir: str) -> list:
+    results = []
+    for duration in args.durations:
+        file_path = os.path.join(input_dir, f"synthetic-{duration:g}s.wav")
+        synthetic_song(file_path, duration)
+        for model in args.models:
+            with ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            ) as pool:
+                case = pool.submit(
+                    run_case,
+                    file_path,
+                    duration,
+                    model,
+                    args.ffmpeg_path,
+                    args.workers,
+                    args.threads,
+                    args.segment_threads,
+                ).result()
+            print(
+                f"{model:>12} {duration:>6g}s  wall {case['wall_time']:.2f}s"
+                f"  rtf {case['real_time_factor']:.3f}"
+                f"  cpu {case['cpu_utilisation']:.1f}"
+                f"  rss {case['peak_rss_mb']:.0f}MB"
+                f"  encode {case['stage_times'].get('encode', 0.0):.2f}s"
+            )
+            results.append(case)
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="benchmark-inputs-") as input_dir:
+        results = run_cases(args, input_dir)
+    report = {
+        "version": read_version(),
+        "created_at": time.time(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"])
+        if regressions:
+            raise SystemExit(f"{len(regressions)} cases regressed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import os
+import subprocess
+import time
+
+from db import connect
+from preview import preview_model
+from stem_store import CANONICAL_BITRATE, CANONICAL_FORMAT, MANIFEST_DB, StemStore
+
+PAGE_SIZE = 50
+
+
+def probe_duration(file_path: str):
+    # seconds, None while ffprobe isn't available or can't read the file
+    try:
+        output = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-show_entries",
+                "format=duration",
+                "-of",
+                "csv=p=0",
+                file_path,
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        return float(output.strip())
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+
+
+# index of the songs of input_dir: their hash, duration and, through the
+# entries of the stem manifest it shares a database with, the models they
+# have complete stems for. Kept up to date as songs are added, and synced
+# with the directory when it changes instead of listing it every rerun
+class Catalogue:
+    def __init__(self, input_dir: str, store: StemStore):
+        self.input_dir = input_dir
+        self.store = store
+        self.synced_mtime_ns = None
+        self.db_path = os.path.join(store.root, MANIFEST_DB)
+        os.makedirs(input_dir, exist_ok=True)
+        with connect(self.db_path) as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS songs (
+                    name TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    hash TEXT,
+                    duration REAL,
+                    added_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS songs_hash ON songs (hash)")
+
+    def add(self, file_path: str, audio_hash: str = None):
+        # (re)indexes a song of input_dir, hashing it if it wasn't already
+        stat = os.stat(file_path)
+        name = os.path.basename(file_path)
+        audio_hash = audio_hash or self.store.hash_song(file_path)
+        with connect(self.db_path) as conn:
+            row = conn.execute(
+                "SELECT duration FROM songs WHERE name = ? AND size = ? AND mtime_ns = ?",
+                (name, stat.st_size, stat.st_mtime_ns),
+            ).fetchone()
+        duration = row["duration"] if row is not None else None
+        if duration is None:
+            duration = probe_duration(file_path)
+        with connect(self.db_path) as conn:
+            conn.execute(
+                "INSERT INTO songs (name, size, mtime_ns, hash, duration, added_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (name) DO UPDATE SET size = excluded.size,"
+                " mtime_ns = excluded.mtime_ns, hash = excluded.hash,"
+                " duration = excluded.duration",
+                (
+                    name,
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    audio_hash,
+                    duration,
+                    time.time(),
+                ),
+            )
+
+    def remove(self, name: str):
+        with connect(self.db_path) as conn:
+            conn.execute("DELETE FROM songs WHERE name = ?", (name,))
+
+    def refresh(self):
+        # syncs if a song was added to or removed from input_dir since the
+        # last sync, a single stat otherwise. The time is taken before
+        # syncing, so that a song added meanwhile is picked up by the next one
+        mtime_ns = os.stat(self.input_dir).st_mtime_ns
+        if mtime_ns != self.synced_mtime_ns:
+            self.sync()
+            self.synced_mtime_ns = mtime_ns
+
+    def sync(self):
+        # picks up songs added, changed or removed outside the app. New songs
+        # are only hashed if the stem manifest already knows them, the others
+        # are hashed when they are first opened
+        with os.scandir(self.input_dir) as entries:
+            files = {
+                entry.name: entry.stat()
+                for entry in entries
+                if entry.is_file() and not entry.name.startswith(".")
+            }
+        with connect(self.db_path) as conn:
+            known = {
+                row["name"]: (row["size"], row["mtime_ns"])
+                for row in conn.execute("SELECT name, size, mtime_ns FROM songs")
+            }
+        changed = [
+            (
+                name,
+                stat.st_size,
+                stat.st_mtime_ns,
+                self.store.cached_hash(os.path.join(self.input_dir, name)),
+                time.time(),
+            )
+            for name, stat in files.items()
+            if known.get(name) != (stat.st_size, stat.st_mtime_ns)
+        ]
+        with connect(self.db_path) as conn:
+            conn.executemany(
+                "DELETE FROM songs WHERE name = ?",
+                [(name,) for name in known.keys() - files.keys()],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO songs (name, size, mtime_ns, hash, added_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                changed,
+            )
+
+    def count(self, query="") -> int:
+        with connect(self.db_path) as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM songs WHERE name LIKE ? ESCAPE '\\'",
+                (self._pattern(query),),
+            ).fetchone()[0]
+
+    def search(self, query="", limit=PAGE_SIZE, offset=0) -> list:
+        # songs whose name contains query, by name, with the models they
+        # have complete stems for, previews aside
+        with connect(self.db_path) as conn:
+            rows = conn.execute(
+                "SELECT songs.name, songs.hash, songs.duration,"
+                " group_concat(entries.model) AS models FROM songs"
+                " LEFT JOIN entries ON entries.hash = songs.hash"
+                " AND entries.format = ? AND entries.bitrate = ?"
+                " AND entries.model NOT LIKE ?"
+                " WHERE songs.name LIKE ? ESCAPE '\\'"
+                " GROUP BY songs.name ORDER BY songs.name COLLATE NOCASE"
+                " LIMIT ? OFFSET ?",
+                (
+                    CANONICAL_FORMAT,
+                    CANONICAL_BITRATE,
+                    preview_model("%"),
+                    self._pattern(query),
+                    limit,
+                    offset,
+                ),
+            ).fetchall()
+        return [
+            dict(row, models=row["models"].split(",") if row["models"] else [])
+            for row in rows
+        ]
+
+    def _pattern(self, query: str) -> str:
+        for char in ("\\", "%", "_"):
+            query = query.replace(char, f"\\{char}")
+        return f"%{query}%"
@@ -0,0 +1,148 @@
+import argparse
+import os
+import time
+
+from catalogue import probe_duration
+from jobs import (
+    ACTIVE_STATES,
+    DONE,
+    JOBS_DB_FILE,
+    POLL_INTERVAL_IN_SECONDS,
+    JobQueue,
+    start_workers,
+)
+from profiles import DEFAULT_PROFILE, INFERENCE_PROFILES, RESIDUAL_STEM, store_model
+from profiling import format_profile, read_profile
+from stem_store import StemStore
+from utils import find_ffmpeg, in_path, install_ffmpeg, out_path
+
+
+def list_songs(input_dir: str = None, manifest: str = None) -> list:
+    if manifest:
+        with open(manifest) as f:
+            return [line.strip() for line in f if line.strip()]
+    return sorted(
+        os.path.join(input_dir, name)
+        for name in os.listdir(input_dir)
+        if not name.startswith(".")
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Split every song of a directory or manifest into stems."
+    )
+    parser.add_argument("input_dir", nargs="?", default=in_path)
+    parser.add_argument("--manifest", help="file with one song path per line")
+    parser.add_argument("-n", "--model", default="htdemucs")
+    parser.add_argument(
+        "--profile", choices=list(INFERENCE_PROFILES), default=DEFAULT_PROFILE
+    )
+    parser.add_argument(
+        "--stems",
+        nargs="+",
+        help=f"only write these stems, the others summed as {RESIDUAL_STEM}",
+    )
+    parser.add_argument("-o", "--output", default=out_path)
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--ffmpeg-path")
+    parser.add_argument(
+        "--profiling",
+        action="store_true",
+        help="save a call and torch operator profile next to the stems of each song",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # ffprobe is needed here for the durations, ffmpeg by the workers
+    if args.ffmpeg_path:
+        os.environ["PATH"] = f"{args.ffmpeg_path}:{os.environ['PATH']}"
+    elif find_ffmpeg() is None:
+        install_ffmpeg()
+    store = StemStore(args.output)
+    # jobs are persisted with the stems, so running the same command again
+    # after a crash resumes where it stopped: finished songs are skipped and
+    # the jobs left running are queued again once their lease expires. Jobs
+    # of other output directories, e.g. the app's, are kept apart
+    db_path = os.path.join(args.output, JOBS_DB_FILE)
+    job_queue = JobQueue(db_path)
+
+    job_ids = {}
+    durations = {}
+    skipped = failed = 0
+    stored_model = store_model(args.model, args.profile, args.stems)
+    for file_path in list_songs(args.input_dir, args.manifest):
+        duration = probe_duration(file_path)
+        if duration is None:
+            failed += 1
+            print(f"failed  {file_path}: unreadable")
+            continue
+        if store.lookup(store.hash_song(file_path), stored_model) is not None:
+            skipped += 1
+            continue
+        # songs of a manifest can share a name, jobs are keyed by path
+        job_ids[file_path] = job_queue.submit(
+            song=os.path.abspath(file_path),
+            model=args.model,
+            file_path=file_path,
+            profile=args.profile,
+            stems=args.stems,
+            profiling=args.profiling,
+        )
+        durations[file_path] = duration
+    print(
+        f"{len(job_ids)} songs to split, {skipped} already split,"
+        f" {failed} unreadable"
+    )
+    if not job_ids:
+        return
+
+    workers = start_workers(
+        output_path=args.output,
+        ffmpeg_path=args.ffmpeg_path,
+        num_workers=min(args.workers, len(job_ids)),
+        db_path=db_path,
+    )
+    start_time = time.time()
+    pending = dict(job_ids)
+    done = 0
+    audio_seconds = 0.0
+    while pending:
+        time.sleep(POLL_INTERVAL_IN_SECONDS)
+        jobs = {
+            file_path: job_queue.get(job_id) for file_path, job_id in pending.items()
+        }
+        finished = [
+            (file_path, job)
+            for file_path, job in jobs.items()
+            if job["status"] not in ACTIVE_STATES
+        ]
+        for file_path, job in finished:
+            del pending[file_path]
+            if job["status"] == DONE:
+                done += 1
+                audio_seconds += durations[file_path]
+                print(f"done    {file_path}")
+                summary = args.profiling and read_profile(
+                    store.stem_dir(store.hash_song(file_path), stored_model)
+                )
+                if summary:
+                    print(format_profile(summary))
+            else:
+                failed += 1
+                print(f"failed  {file_path}: {job['error']}")
+        elapsed = time.time() - start_time
+        if finished:
+            print(
+                f"[{len(job_ids) - len(pending)}/{len(job_ids)}] "
+                f"{done / elapsed * 60:.2f} songs/min, "
+                f"{audio_seconds / elapsed:.2f} audio-s/s"
+            )
+    workers.stop()
+    print(f"{done} songs split, {failed} failed in {time.time() - start_time:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+import json
+
 import streamlit as st
 
 STEMS_EMOJIS = {
@@ -7,17 +9,25 @@ STEMS_EMOJIS = {
     "other": "🎶",
     "piano": "🎹",
     "guitar": "🎸",
+    "accompaniment": "🎼",
 }
 
 
-def display_audio(song, stems, model):
-    src_stems = {key: f"data:audio/mp3;base64,{value}" for key, value in stems.items()}
-
+def display_audio(song, stems, model, peaks=None):
+    # stems maps each stem to the URL it is streamed from, peaks is the
+    # sidecar index of the stems, used to draw the waveform and show the
+    # duration before any audio is loaded
+    duration = peaks["duration"] if peaks else 0
+    envelopes = {
+        stem: envelope
+        for stem, envelope in (peaks["stems"] if peaks else {}).items()
+        if stem in stems
+    }
     audio_columns = ""
-    for stem, src in src_stems.items():
+    for stem, src in stems.items():
         audio_columns += f"""
         <div class="audio-column">
-            <audio id="{stem}" src="{src}" preload="auto"></audio>
+            <audio id="{stem}" src="{src}" preload="metadata"></audio>
             <div class="audio-control">
                 <label>{STEMS_EMOJIS[stem]} {stem.capitalize()}</label>
                 <div style="display: flex; align-items: center; justify-content: center; gap: 10px;">
@@ -90,6 +100,7 @@ input[type="range"] {{
 
 <div style="margin-top: 5%;">
     <div style="position: relative; width: 80%; margin: 0 auto;">
+        <canvas id="waveform" height="60" style="width: 100%; height: 60px; display: block;"></canvas>
         <input type="range" id="seekbar" value="0" min="0" step="0.01" style="width: 100%; z-index: 1; position: relative;">
         <div id="markers" style="position: relative; top: -10px; width: 100%; height: 20px; z-index: 2;">
             <div id="selected-area" style="position: absolute; top: 50%; height: 5px; background-color: green; z-index: -1; border-radius: 5px;"></div>
@@ -105,7 +116,7 @@ input[type="range"] {{
 </div>
 
 <script>
-const stems = {list(src_stems.keys())};
+const stems = {list(stems.keys())};
 const seekbar = document.getElementById("seekbar");
 const audioElements = stems.reduce((acc, stem) => {{
     acc[stem] = document.getElementById(stem);
@@ -132,13 +143,45 @@ speedControl.addEventListener("input", () => {{
     }});
 }});
 
+const knownDuration = {duration};
+const envelopes = {json.dumps(envelopes)};
+
+function stemsDuration() {{
+    if (knownDuration > 0) {{
+        return knownDuration;
+    }}
+    return Math.min(...Object.values(audioElements).map(audio => audio.duration || 0));
+}}
+
+function drawWaveform() {{
+    // envelope of the mix, as the sum of the stem envelopes
+    const canvas = document.getElementById("waveform");
+    const lows = Object.values(envelopes).map(envelope => envelope.min);
+    const highs = Object.values(envelopes).map(envelope => envelope.max);
+    if (!lows.length) {{
+        canvas.style.display = "none";
+        return;
+    }}
+    canvas.width = canvas.offsetWidth;
+    const context = canvas.getContext("2d");
+    const bins = lows[0].length;
+    const middle = canvas.height / 2;
+    context.fillStyle = "#9ccc9c";
+    for (let x = 0; x < canvas.width; x++) {{
+        const bin = Math.floor(x * bins / canvas.width);
+        const low = Math.max(lows.reduce((sum, peaks) => sum + peaks[bin], 0) / 127, -1);
+        const high = Math.min(highs.reduce((sum, peaks) => sum + peaks[bin], 0) / 127, 1);
+        context.fillRect(x, middle - high * middle, 1, Math.max((high - low) * middle, 1));
+    }}
+}}
+
 let seekbarWidth = seekbar.offsetWidth;
 let maxDuration = 0;
 let loopStartTime = 0;
 
 function initializeAudio() {{
     if (maxDuration === 0) {{
-        maxDuration = Math.min(...Object.values(audioElements).map(audio => audio.duration || 0));
+        maxDuration = stemsDuration();
         seekbar.max = maxDuration;
         seekbarWidth = seekbar.offsetWidth;
         updateSelectedArea();
@@ -149,14 +192,14 @@ function initializeAudio() {{
 
 Object.values(audioElements).forEach(audio => {{
     audio.addEventListener("loadedmetadata", () => {{
-        maxDuration = Math.min(...Object.values(audioElements).map(audio => audio.duration || 0));
+        maxDuration = stemsDuration();
         seekbar.max = maxDuration;
         updateTimeDisplay(0);
     }});
 }});
 
 function updateTimeDisplay(pos) {{
-    const total = Math.min(...Object.values(audioElements).map(audio => audio.duration || 0));
+    const total = stemsDuration();
     const formatTime = (time) => {{
         const minutes = Math.floor(time / 60);
         const seconds = Math.floor(time % 60).toString().padStart(2, '0');
@@ -195,7 +238,7 @@ function getTimeFromMarker(marker) {{
 }}
 
 function playAll() {{
-    maxDuration = Math.min(...Object.values(audioElements).map(audio => audio.duration || 0));
+    maxDuration = stemsDuration();
     seekbar.max = maxDuration;
     seekbarWidth = seekbar.offsetWidth;
     updateSelectedArea();
@@ -208,7 +251,8 @@ function playAll() {{
 }}
 
 document.addEventListener("DOMContentLoaded", () => {{
-    maxDuration = Math.min(...Object.values(audioElements).map(audio => audio.duration || 0));
+    drawWaveform();
+    maxDuration = stemsDuration();
     seekbar.max = maxDuration;
     seekbarWidth = seekbar.offsetWidth;
     updateSelectedArea();
@@ -308,7 +352,7 @@ endMarker.addEventListener("touchend", (event) => {{
 setInterval(() => {{
     if (Object.values(audioElements).every(audio => !audio.paused)) {{
         const pos = Math.min(...Object.values(audioElements).map(audio => audio.currentTime));
-        const total = Math.min(...Object.values(audioElements).map(audio => audio.duration || 0));
+        const total = stemsDuration();
         seekbar.value = pos;
         updateTimeDisplay(pos);
 
@@ -338,5 +382,5 @@ Object.entries(volumeControls).forEach(([stem, control]) => {{
 """
 
     st.components.v1.html(
-        html_code, height=460 if len(stems) > 4 else 370, scrolling=True
+        html_code, height=520 if len(stems) > 4 else 430, scrolling=True
     )
@@ -0,0 +1,27 @@
+import contextlib
+import os
+import sqlite3
+
+# set when replicas on several hosts share the databases over one volume.
+# WAL needs memory shared between the processes using a database, so it only
+# works on a single host; the rollback journal works across hosts as long as
+# the volume supports file locking
+MULTI_HOST = os.environ.get("MULTI_HOST", "") == "1"
+JOURNAL_MODE = "DELETE" if MULTI_HOST else "WAL"
+# seconds a statement waits for another connection's write lock
+BUSY_TIMEOUT_SECONDS = 30
+
+
+@contextlib.contextmanager
+def connect(db_path: str, timeout=BUSY_TIMEOUT_SECONDS):
+    # autocommit mode, transactions are opened explicitly where needed
+    conn = sqlite3.connect(db_path, timeout=timeout, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def set_journal_mode(conn):
+    conn.execute(f"PRAGMA journal_mode={JOURNAL_MODE}")
@@ -0,0 +1,104 @@
+import mimetypes
+import os
+import subprocess
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from metrics import log_event, metrics
+from pcm_cache import CHANNELS, SAMPLERATE
+from stem_store import StemStore
+
+ENCODE_WORKERS = int(os.environ.get("ENCODE_WORKERS", 2))
+# bitrate 0 is used for the lossless formats
+FORMATS = {
+    "mp3": {"codec": "libmp3lame", "mime": "audio/mpeg", "bitrates": [128, 192, 320]},
+    "opus": {"codec": "libopus", "mime": "audio/ogg", "bitrates": [64, 96, 128]},
+    "ogg": {"codec": "libvorbis", "mime": "audio/ogg", "bitrates": [96, 128, 192]},
+    "flac": {"codec": "flac", "mime": "audio/flac", "bitrates": [0]},
+    "wav": {"codec": "pcm_s16le", "mime": "audio/wav", "bitrates": [0]},
+}
+
+for output_format, options in FORMATS.items():
+    mimetypes.add_type(options["mime"], f".{output_format}")
+
+
+def encode_pcm(pcm_path: str, output_path: str, output_format: str, bitrate: int):
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    command = [
+        "ffmpeg",
+        "-y",
+        "-loglevel",
+        "error",
+        "-f",
+        "f32le",
+        "-ar",
+        str(SAMPLERATE),
+        "-ac",
+        str(CHANNELS),
+        "-i",
+        pcm_path,
+        "-c:a",
+        FORMATS[output_format]["codec"],
+    ]
+    if bitrate:
+        command += ["-b:a", f"{bitrate}k"]
+    command += ["-f", output_format, tmp_path]
+    subprocess.run(command, check=True)
+    # readers only ever see complete files
+    os.replace(tmp_path, output_path)
+
+
+# encodes stems from their canonical PCM to a delivery format the first time
+# that (format, bitrate) is requested, the result is kept next to the PCM
+class StemEncoder:
+    def __init__(self, store: StemStore, workers=ENCODE_WORKERS):
+        self.store = store
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def submit(
+        self, audio_hash: str, model: str, stem: str, output_format: str, bitrate: int
+    ):
+        if (
+            output_format not in FORMATS
+            or bitrate not in FORMATS[output_format]["bitrates"]
+        ):
+            raise ValueError(f"Unsupported format {output_format} at {bitrate}k")
+        output_path = self.store.stem_path(
+            audio_hash, model, stem, output_format, bitrate
+        )
+        if os.path.exists(output_path):
+            future = Future()
+            future.set_result(output_path)
+            return future
+        with self.lock:
+            # concurrent requests for the same variant share one encode
+            future = self.pending.get(output_path)
+            if future is None:
+                future = self.pool.submit(
+                    self._encode,
+                    self.store.stem_path(audio_hash, model, stem),
+                    output_path,
+                    output_format,
+                    bitrate,
+                )
+                self.pending[output_path] = future
+        return future
+
+    def _encode(self, pcm_path, output_path, output_format, bitrate):
+        try:
+            if not os.path.exists(output_path):
+                with metrics.timed("encode", format=output_format):
+                    encode_pcm(pcm_path, output_path, output_format, bitrate)
+                log_event("stem_encoded", path=output_path)
+            return output_path
+        finally:
+            with self.lock:
+                self.pending.pop(output_path, None)
+
+    def encode(
+        self, audio_hash: str, model: str, stem: str, output_format: str, bitrate: int
+    ) -> str:
+        return self.submit(audio_hash, model, stem, output_format, bitrate).result()
@@ -0,0 +1,359 @@
+import contextlib
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+from demucs.apply import apply_model
+from demucs.audio import convert_audio
+from demucs.pretrained import get_model
+
+from pcm_cache import CHANNELS, SAMPLERATE
+from peaks import PeakAccumulator, samples_per_peak, write_peaks
+from profiles import (
+    DEFAULT_PROFILE,
+    INFERENCE_PROFILES,
+    RESIDUAL_STEM,
+    bfloat16_supported,
+    configure_threads,
+    output_stems,
+)
+from progress import scaled_progress
+
+MODEL_MEMORY_BUDGET_IN_BYTES = int(
+    os.environ.get("MODEL_MEMORY_BUDGET_IN_BYTES", 1024**3)
+)
+# inputs longer than this are separated chunk by chunk
+STREAMING_MIN_DURATION_IN_SECONDS = 600
+CHUNK_SECONDS = 60
+OVERLAP_SECONDS = 2
+# parallel mode: each song is split across PARALLEL_WORKERS processes,
+# each running torch with THREADS_PER_WORKER threads
+PARALLEL_WORKERS = int(os.environ.get("PARALLEL_WORKERS", 1))
+THREADS_PER_WORKER = int(os.environ.get("THREADS_PER_WORKER", 1))
+SEGMENT_OVERLAP_SECONDS = 2
+
+
+def model_size(model) -> int:
+    return sum(p.numel() * p.element_size() for p in model.parameters())
+
+
+def _init_segment_worker(threads: int):
+    configure_threads(threads, interop_threads=1)
+
+
+def _separate_segment(model_name: str, mix, profile: str):
+    # runs in the segment pool, each process keeps its own copy of the model
+    engine = get_engine()
+    model = engine.get_model(model_name, INFERENCE_PROFILES[profile]["precision"])
+    return engine.apply(model, mix, profile=profile)
+
+
+def crossfade_weight(length: int, fade_in: int, fade_out: int):
+    # linear ramps over the regions shared with the neighbouring segments
+    weight = torch.ones(length)
+    fade_in, fade_out = min(fade_in, length), min(fade_out, length)
+    if fade_in:
+        weight[:fade_in] = torch.arange(1, fade_in + 1) / (fade_in + 1)
+    if fade_out:
+        weight[-fade_out:] = torch.arange(fade_out, 0, -1) / (fade_out + 1)
+    return weight
+
+
+def select_stems(sources: dict, stems=None) -> dict:
+    # the stems asked for, the others summed as RESIDUAL_STEM
+    names = output_stems(list(sources), stems)
+    selected = {stem: sources[stem] for stem in names if stem in sources}
+    if RESIDUAL_STEM in names:
+        selected[RESIDUAL_STEM] = torch.stack(
+            [source for stem, source in sources.items() if stem not in selected]
+        ).sum(0)
+    return selected
+
+
+# appends a stem as raw float32 PCM, in the canonical format of pcm_cache,
+# as chunks come in, recording its peaks on the way
+class PcmStreamWriter:
+    def __init__(self, path: str, samples_per_peak: int):
+        self.file = open(path, "wb")
+        self.peaks = PeakAccumulator(samples_per_peak)
+
+    def write(self, wav):
+        data = wav.t().contiguous().numpy()
+        self.file.write(data.tobytes())
+        self.file.flush()
+        self.peaks.add(data)
+
+    def close(self):
+        self.file.close()
+
+
+# keeps the demucs models loaded across jobs, evicting the least recently used
+# one when the loaded models don't fit in the memory budget
+class SeparationEngine:
+    def __init__(
+        self,
+        memory_budget=MODEL_MEMORY_BUDGET_IN_BYTES,
+        device="cpu",
+        workers=PARALLEL_WORKERS,
+        threads_per_worker=THREADS_PER_WORKER,
+    ):
+        self.memory_budget = memory_budget
+        self.device = device
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+        self.models = OrderedDict()
+        self.pool = None
+        # seconds spent per stage, reset by separate_tracks for each song
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def timed(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = (
+                self.timings.get(stage, 0.0) + time.perf_counter() - start
+            )
+
+    def get_pool(self) -> ProcessPoolExecutor:
+        # created on first use and kept so that segment workers load each
+        # model only once
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_segment_worker,
+                initargs=(self.threads_per_worker,),
+            )
+        return self.pool
+
+    def get_model(self, name: str, precision="float32"):
+        # bfloat16 runs the float32 model under autocast, int8 needs a
+        # quantized copy
+        key = f"{name}:int8" if precision == "int8" else name
+        if key in self.models:
+            self.models.move_to_end(key)
+            return self.models[key]
+        with self.timed("model_load"):
+            model = get_model(name=name)
+            model.to(self.device)
+            model.eval()
+            if precision == "int8":
+                model = torch.ao.quantization.quantize_dynamic(
+                    model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8
+                )
+        self.models[key] = model
+        # never evict the model that was just requested
+        while (
+            len(self.models) > 1
+            and sum(model_size(m) for m in self.models.values()) > self.memory_budget
+        ):
+            self.models.popitem(last=False)
+        return model
+
+    def apply(self, model, mix, progress=None, profile=DEFAULT_PROFILE):
+        options = INFERENCE_PROFILES[profile]
+        callback = None
+        if progress is not None:
+            models = len(getattr(model, "models", [model]))
+
+            def callback(event):
+                if event.get("state") == "end":
+                    offset = event["segment_offset"] / mix.shape[-1]
+                    progress((event["model_idx_in_bag"] + min(offset, 1.0)) / models)
+
+        bfloat16 = options["precision"] == "bfloat16" and bfloat16_supported()
+        with (
+            torch.no_grad(),
+            torch.autocast("cpu", dtype=torch.bfloat16, enabled=bfloat16),
+        ):
+            sources = apply_model(
+                model,
+                mix[None],
+                device=self.device,
+                shifts=options["shifts"],
+                overlap=options["overlap"],
+                callback=callback,
+            )
+        if progress is not None:
+            progress(1.0)
+        return sources[0].float()
+
+    def separate(
+        self, wav, model_name: str, progress=None, profile=DEFAULT_PROFILE
+    ) -> dict:
+        # wav is in the canonical format of pcm_cache
+        model = self.get_model(model_name, INFERENCE_PROFILES[profile]["precision"])
+        if (model.samplerate, model.audio_channels) != (SAMPLERATE, CHANNELS):
+            wav = convert_audio(wav, SAMPLERATE, model.samplerate, model.audio_channels)
+        ref = wav.mean(0)
+        # silent chunks would otherwise divide by zero
+        mean, std = ref.mean(), ref.std() + 1e-8
+        mix = ((wav - mean) / std).contiguous()
+        if self.workers > 1:
+            sources = self.apply_parallel(model, model_name, mix, progress, profile)
+        else:
+            sources = self.apply(model, mix, progress, profile)
+        sources = sources * std + mean
+        return dict(zip(model.sources, sources))
+
+    def apply_parallel(
+        self, model, model_name: str, mix, progress=None, profile=DEFAULT_PROFILE
+    ):
+        # splits the mix into one overlapping segment per worker and stitches
+        # the separated segments back with overlap-add
+        length = mix.shape[-1]
+        overlap = int(SEGMENT_OVERLAP_SECONDS * model.samplerate)
+        segment = -(-length // self.workers)
+        if segment <= 2 * overlap:
+            return self.apply(model, mix, progress, profile)
+        pool = self.get_pool()
+        futures = []
+        for offset in range(0, length, segment):
+            start = max(offset - overlap, 0)
+            end = min(offset + segment + overlap, length)
+            future = pool.submit(
+                _separate_segment, model_name, mix[..., start:end], profile
+            )
+            futures.append((start, end, future))
+        out = torch.zeros(len(model.sources), *mix.shape)
+        total_weight = torch.zeros(length)
+        for done, (start, end, future) in enumerate(futures, 1):
+            weight = crossfade_weight(
+                end - start,
+                fade_in=2 * overlap if start > 0 else 0,
+                fade_out=2 * overlap if end < length else 0,
+            )
+            out[..., start:end] += future.result() * weight
+            total_weight[start:end] += weight
+            if progress is not None:
+                progress(done / len(futures))
+        return out / total_weight
+
+    def separate_to_files(
+        self,
+        wav,
+        output_dir: str,
+        model_name: str,
+        progress=None,
+        profile=DEFAULT_PROFILE,
+        stems=None,
+    ) -> list:
+        # writes {output_dir}/{stem}.f32 and their peaks for the stems asked
+        # for, and returns the stems written
+        with self.timed("inference"):
+            stems = select_stems(
+                self.separate(wav, model_name, progress, profile), stems
+            )
+        os.makedirs(output_dir, exist_ok=True)
+        peaks = {}
+        with self.timed("write"):
+            for stem, source in stems.items():
+                writer = PcmStreamWriter(
+                    os.path.join(output_dir, f"{stem}.f32"),
+                    samples_per_peak(source.shape[-1]),
+                )
+                writer.write(source)
+                writer.close()
+                peaks[stem] = writer.peaks
+            model = self.get_model(model_name, INFERENCE_PROFILES[profile]["precision"])
+            write_peaks(output_dir, model.samplerate, peaks)
+        return list(stems)
+
+    def separate_to_files_streaming(
+        self,
+        wav,
+        output_dir: str,
+        model_name: str,
+        chunk_seconds=CHUNK_SECONDS,
+        overlap_seconds=OVERLAP_SECONDS,
+        progress=None,
+        profile=DEFAULT_PROFILE,
+        stems=None,
+    ) -> list:
+        # separates windows of chunk_seconds + overlap_seconds of the
+        # memory-mapped input, crossfading each window into the tail of the
+        # previous one, so that memory is bounded by the chunk size instead of
+        # the track length. The stems are only playable once the whole song is
+        # written and committed, what plays meanwhile is the preview (see
+        # preview.py)
+        model = self.get_model(model_name, INFERENCE_PROFILES[profile]["precision"])
+        length = wav.shape[-1]
+        chunk = int(chunk_seconds * SAMPLERATE)
+        overlap = int(overlap_seconds * SAMPLERATE)
+        # the output is at the model's samplerate
+        output_chunk = int(chunk_seconds * model.samplerate)
+        output_overlap = int(overlap_seconds * model.samplerate)
+        fade_in = torch.linspace(0, 1, output_overlap)
+        names = output_stems(model.sources, stems)
+        os.makedirs(output_dir, exist_ok=True)
+        output_length = length * model.samplerate // SAMPLERATE
+        writers = [
+            PcmStreamWriter(
+                os.path.join(output_dir, f"{stem}.f32"),
+                samples_per_peak(output_length),
+            )
+            for stem in names
+        ]
+        tail = None
+        try:
+            for start in range(0, length, chunk):
+                chunk_progress = None
+                if progress is not None:
+                    chunk_progress = scaled_progress(
+                        progress, start / length, min(start + chunk, length) / length
+                    )
+                # [stems, channels, samples]
+                with self.timed("inference"):
+                    sources = torch.stack(
+                        list(
+                            select_stems(
+                                self.separate(
+                                    wav[..., start : start + chunk + overlap],
+                                    model_name,
+                                    chunk_progress,
+                                    profile,
+                                ),
+                                stems,
+                            ).values()
+                        )
+                    )
+                if tail is not None:
+                    n = min(tail.shape[-1], sources.shape[-1])
+                    sources[..., :n] = (
+                        tail[..., :n] * (1 - fade_in[:n])
+                        + sources[..., :n] * fade_in[:n]
+                    )
+                if start + chunk < length:
+                    sources, tail = (
+                        sources[..., :output_chunk],
+                        sources[..., output_chunk:],
+                    )
+                with self.timed("write"):
+                    for writer, source in zip(writers, sources):
+                        writer.write(source)
+        finally:
+            for writer in writers:
+                writer.close()
+        with self.timed("write"):
+            write_peaks(
+                output_dir,
+                model.samplerate,
+                {stem: writer.peaks for stem, writer in zip(names, writers)},
+            )
+        return names
+
+
+_engine = None
+
+
+def get_engine() -> SeparationEngine:
+    # one engine per worker process, created on first use
+    global _engine
+    if _engine is None:
+        _engine = SeparationEngine()
+    return _engine
@@ -0,0 +1,159 @@
+import argparse
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+
+import torch
+
+from benchmark import synthetic_song
+from engine import get_engine
+from pcm_cache import PcmCache
+from profiles import INFERENCE_PROFILES, bfloat16_supported, configure_threads
+from stem_store import hash_file
+from utils import install_ffmpeg, read_version
+
+MODELS = ["htdemucs"]
+FIXTURE_SECONDS = 30
+REFERENCE_PROFILE = "full"
+# SDR against the full precision output above which a profile's stems are
+# considered indistinguishable from it
+MIN_SDR = 30.0
+
+
+def sdr(reference, estimate) -> float:
+    # signal to distortion ratio of estimate against reference, in dB
+    signal = reference.pow(2).sum()
+    noise = (reference - estimate).pow(2).sum().clamp(min=1e-12)
+    return float(10 * torch.log10(signal.clamp(min=1e-12) / noise))
+
+
+def evaluate(wav, model: str, profiles: list) -> list:
+    # separates wav with every profile, the reference one first
+    engine = get_engine()
+    results = []
+    reference = reference_time = None
+    profiles = [REFERENCE_PROFILE] + [p for p in profiles if p != REFERENCE_PROFILE]
+    for profile in profiles:
+        # model loading and quantization are not part of the timings
+        engine.get_model(model, INFERENCE_PROFILES[profile]["precision"])
+        # apply_model draws its random shifts from random
+        random.seed(0)
+        start_time = time.perf_counter()
+        stems = engine.separate(wav, model, profile=profile)
+        wall_time = time.perf_counter() - start_time
+        if reference is None:
+            reference, reference_time = stems, wall_time
+        stem_sdrs = (
+            {stem: sdr(reference[stem], source) for stem, source in stems.items()}
+            if profile != REFERENCE_PROFILE
+            else None
+        )
+        results.append(
+            {
+                "model": model,
+                "profile": profile,
+                **INFERENCE_PROFILES[profile],
+                "wall_time": wall_time,
+                "speedup": reference_time / wall_time,
+                "sdr": stem_sdrs,
+                "mean_sdr": (
+                    sum(stem_sdrs.values()) / len(stem_sdrs) if stem_sdrs else None
+                ),
+            }
+        )
+    return results
+
+
+def suggest_default(results: list, min_sdr: float) -> str:
+    # the fastest profile whose stems stay above min_sdr on every fixture
+    speedups = {}
+    for case in results:
+        if case["profile"] == REFERENCE_PROFILE:
+            continue
+        speedups.setdefault(case["profile"], []).append(
+            case["speedup"] if case["mean_sdr"] >= min_sdr else None
+        )
+    candidates = {
+        profile: sum(values) / len(values)
+        for profile, values in speedups.items()
+        if None not in values
+    }
+    faster = {
+        profile: speedup for profile, speedup in candidates.items() if speedup > 1
+    }
+    return max(faster, key=faster.get) if faster else REFERENCE_PROFILE
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare the speed and quality of the inference profiles."
+    )
+    parser.add_argument(
+        "files", nargs="*", help="fixture songs, a synthetic one if none are given"
+    )
+    parser.add_argument("--models", nargs="+", default=MODELS)
+    parser.add_argument(
+        "--profiles",
+        nargs="+",
+        choices=list(INFERENCE_PROFILES),
+        default=list(INFERENCE_PROFILES),
+    )
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--min-sdr", type=float, default=MIN_SDR)
+    parser.add_argument("-o", "--output", default="evaluation.json")
+    return parser.parse_args(argv)
+
+
+def run_fixtures(args, work_dir: str) -> list:
+    # the synthetic song and the decoded fixtures are written to work_dir
+    files = args.files
+    if not files:
+        files = [os.path.join(work_dir, f"synthetic-{FIXTURE_SECONDS}s.wav")]
+        synthetic_song(files[0], FIXTURE_SECONDS)
+    pcm_cache = PcmCache(work_dir)
+
+    results = []
+    for file_path in files:
+        wav = pcm_cache.load(file_path, hash_file(file_path))
+        for model in args.models:
+            for case in evaluate(wav, model, args.profiles):
+                case["file"] = os.path.basename(file_path)
+                mean_sdr = case["mean_sdr"]
+                print(
+                    f"{case['file'][:24]:>24} {model:>12} {case['profile']:>6}"
+                    f"  wall {case['wall_time']:.2f}s  {case['speedup']:.2f}x"
+                    + (f"  sdr {mean_sdr:.1f}dB" if mean_sdr is not None else "")
+                )
+                results.append(case)
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_threads(args.threads)
+    install_ffmpeg()
+    with tempfile.TemporaryDirectory(prefix="evaluate-") as work_dir:
+        results = run_fixtures(args, work_dir)
+    default = suggest_default(results, args.min_sdr)
+    print(f"Suggested default profile: {default}")
+    report = {
+        "version": read_version(),
+        "created_at": time.time(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "bfloat16_supported": bfloat16_supported(),
+        "min_sdr": args.min_sdr,
+        "suggested_default": default,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlparse
+
+from db import connect, set_journal_mode
+from metrics import log_event, metrics
+
+DOWNLOADS_DB = "separated/downloads.db"
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 2))
+DOWNLOAD_RETRIES = 10
+
+DOWNLOADING = "downloading"
+DOWNLOADED = "done"
+DOWNLOAD_FAILED = "failed"
+
+VIDEO_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{11}$")
+YOUTUBE_HOSTS = (
+    "youtube.com",
+    "www.youtube.com",
+    "m.youtube.com",
+    "music.youtube.com",
+    "youtube-nocookie.com",
+    "www.youtube-nocookie.com",
+)
+# /shorts/{id}, /embed/{id}, ...
+YOUTUBE_ID_PATHS = ("shorts", "embed", "live", "v")
+
+
+def video_id(url: str):
+    # the 11 character id of a YouTube link, whatever its form and tracking
+    # params (si=, t=, list=, ...), None if it isn't one
+    url = url.strip()
+    if VIDEO_ID_PATTERN.match(url):
+        return url
+    parsed = urlparse(url if "://" in url else f"https://{url}")
+    host = (parsed.hostname or "").lower()
+    path = [part for part in parsed.path.split("/") if part]
+    candidate = None
+    if host in ("youtu.be", "www.youtu.be"):
+        candidate = path[0] if path else None
+    elif host in YOUTUBE_HOSTS:
+        if path == ["watch"]:
+            candidate = parse_qs(parsed.query).get("v", [None])[0]
+        elif len(path) >= 2 and path[0] in YOUTUBE_ID_PATHS:
+            candidate = path[1]
+    if candidate and VIDEO_ID_PATTERN.match(candidate):
+        return candidate
+    return None
+
+
+def video_url(video_id: str) -> str:
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+
+def download_video(video_id: str, input_dir: str) -> str:
+    import yt_dlp
+
+    # keep the original audio stream, it is decoded once for separation and
+    # transcoding it to mp3 first would only add a lossy encode. The id in
+    # the name keeps videos with the same title apart, and an interrupted
+    # download is resumed from its .part file
+    ydl_opts = {
+        "format": "bestaudio/best",
+        "outtmpl": f"{input_dir}/%(title)s [%(id)s].%(ext)s",
+        "noplaylist": True,
+        "continuedl": True,
+        "retries": DOWNLOAD_RETRIES,
+        "fragment_retries": DOWNLOAD_RETRIES,
+        "http_headers": {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+        },
+    }
+
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(video_url(video_id), download=True)
+        return ydl.prepare_filename(info)
+
+
+# downloads YouTube songs into input_dir in a bounded background pool, with
+# an index from video id to the downloaded file so that a video is only ever
+# downloaded once. on_download(song, file_path, model) is called when a
+# download requested with a model completes, e.g. to queue its separation
+class YouTubeIngester:
+    def __init__(
+        self,
+        input_dir: str,
+        db_path=DOWNLOADS_DB,
+        workers=DOWNLOAD_WORKERS,
+        on_download=None,
+    ):
+        self.input_dir = input_dir
+        self.db_path = db_path
+        self.on_download = on_download
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.pending = set()
+        self.lock = threading.Lock()
+        os.makedirs(input_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with connect(self.db_path) as conn:
+            set_journal_mode(conn)
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS downloads (
+                    video_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    file_name TEXT,
+                    model TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    finished_at REAL
+                )
+                """
+            )
+            interrupted = conn.execute(
+                "SELECT video_id FROM downloads WHERE status = ?", (DOWNLOADING,)
+            ).fetchall()
+        # downloads cut short by the previous server pick up where they were
+        for row in interrupted:
+            self._schedule(row["video_id"])
+
+    def get(self, video_id: str):
+        with connect(self.db_path) as conn:
+            row = conn.execute(
+                "SELECT * FROM downloads WHERE video_id = ?", (video_id,)
+            ).fetchone()
+        return dict(row) if row is not None else None
+
+    def file_path(self, download: dict) -> str:
+        return os.path.join(self.input_dir, download["file_name"])
+
+    def submit(self, url: str, model=None, retry=False):
+        # returns the video id of the link, None if it isn't a YouTube link.
+        # Videos already downloaded are hits, failed downloads are only
+        # retried when asked to, so that polling a failed link doesn't
+        # download it in a loop
+        video = video_id(url)
+        if video is None:
+            return None
+        download = self.get(video)
+        if download is not None:
+            if download["status"] == DOWNLOADED and os.path.exists(
+                self.file_path(download)
+            ):
+                return video
+            if download["status"] == DOWNLOAD_FAILED and not retry:
+                return video
+        with connect(self.db_path) as conn:
+            conn.execute(
+                "INSERT INTO downloads (video_id, status, model, created_at)"
+                " VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (video_id) DO UPDATE SET status = excluded.status,"
+                " model = COALESCE(excluded.model, model), error = NULL",
+                (video, DOWNLOADING, model, time.time()),
+            )
+        self._schedule(video)
+        return video
+
+    def _schedule(self, video: str):
+        # concurrent requests for the same video share one download
+        with self.lock:
+            if video in self.pending:
+                return
+            self.pending.add(video)
+        self.pool.submit(self._download, video)
+
+    def _download(self, video: str):
+        try:
+            try:
+                with metrics.timed("download"):
+                    file_path = download_video(video, self.input_dir)
+            except Exception as e:
+                metrics.inc("downloads_total", result="failed")
+                log_event("download_failed", video_id=video, error=repr(e))
+                with connect(self.db_path) as conn:
+                    conn.execute(
+                        "UPDATE downloads SET status = ?, error = ?, finished_at = ?"
+                        " WHERE video_id = ?",
+                        (DOWNLOAD_FAILED, repr(e), time.time(), video),
+                    )
+                return
+            metrics.inc("downloads_total", result="done")
+            log_event("download_done", video_id=video, file_path=file_path)
+            with connect(self.db_path) as conn:
+                conn.execute(
+                    "UPDATE downloads SET status = ?, file_name = ?, finished_at = ?"
+                    " WHERE video_id = ?",
+                    (DOWNLOADED, os.path.basename(file_path), time.time(), video),
+                )
+            download = self.get(video)
+            if download["model"] and self.on_download:
+                self.on_download(
+                    download["file_name"], self.file_path(download), download["model"]
+                )
+        finally:
+            with self.lock:
+                self.pending.discard(video)
@@ -0,0 +1,78 @@
+import hashlib
+import os
+import threading
+
+from pcm_cache import PcmCache
+from stem_store import StemStore
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 200 * 1024**2))
+# decode uploads to the canonical PCM right away instead of when they are
+# first separated
+DECODE_UPLOADS = os.environ.get("DECODE_UPLOADS", "0") == "1"
+
+
+# uploads are streamed to root chunk by chunk and hashed on the way, then
+# kept under their own name unless an input with the same content is already
+# there, in which case that one is reused
+class InputStore:
+    def __init__(
+        self,
+        root: str,
+        store: StemStore,
+        pcm_cache: PcmCache = None,
+        max_bytes=MAX_UPLOAD_BYTES,
+    ):
+        self.root = root
+        self.store = store
+        self.pcm_cache = pcm_cache
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def save(self, stream, name: str) -> str:
+        # returns the path of the input with the content of stream
+        tmp_path = os.path.join(
+            self.root, f".upload.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        sha = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b""):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise ValueError(
+                            f"Uploads are limited to {self.max_bytes // 1024**2} MB"
+                        )
+                    sha.update(chunk)
+                    f.write(chunk)
+            audio_hash = sha.hexdigest()
+            file_path = self.store.find_input(audio_hash, self.root)
+            if file_path is None:
+                file_path = self._link(tmp_path, name, audio_hash)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if self.pcm_cache is not None:
+            self.pcm_cache.decode(file_path, audio_hash)
+        return file_path
+
+    def _link(self, tmp_path: str, name: str, audio_hash: str) -> str:
+        # a different song uploaded under an existing name gets a new name
+        # instead of reusing the stems of the old one. Linking fails if the
+        # name was taken in the meantime, so concurrent uploads never
+        # overwrite each other
+        base, ext = os.path.splitext(os.path.basename(name))
+        file_path = os.path.join(self.root, f"{base}{ext}")
+        copy = 1
+        while True:
+            try:
+                os.link(tmp_path, file_path)
+            except FileExistsError:
+                if self.store.hash_song(file_path) == audio_hash:
+                    return file_path
+                file_path = os.path.join(self.root, f"{base} ({copy}){ext}")
+                copy += 1
+            else:
+                self.store.record_input(file_path, audio_hash)
+                return file_path
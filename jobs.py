@@ -0,0 +1,454 @@
+import atexit
+import contextlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+from db import connect, set_journal_mode
+from leases import LEASE_SECONDS, RENEW_TIMEOUT_SECONDS, heartbeat
+from metrics import log_event, peak_rss_bytes, reset_peak_rss
+from profiles import DEFAULT_PROFILE, INFERENCE_THREADS, configure_threads
+from progress import ProgressReporter
+from stem_store import StemStore
+from storage import StorageManager
+from utils import separate_tracks
+
+JOBS_DB_FILE = "jobs.db"
+JOBS_DB = os.path.join("separated", JOBS_DB_FILE)
+NUM_WORKERS = int(os.environ.get("SEPARATION_WORKERS", 2))
+POLL_INTERVAL_IN_SECONDS = 1
+WORKER_CHECK_SECONDS = 5
+# a job whose worker died this many times, e.g. killed for running out of
+# memory on a huge input, is failed instead of being queued again
+MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+ACTIVE_STATES = (QUEUED, RUNNING)
+# workers take the highest priority job first: previews the user is waiting
+# for, then the songs they asked for, then bulk jobs (e.g. from the CLI)
+BULK_PRIORITY = 0
+FULL_PRIORITY = 1
+PREVIEW_PRIORITY = 2
+MIGRATED_COLUMNS = {
+    "progress": "REAL NOT NULL DEFAULT 0",
+    "profile": "TEXT NOT NULL DEFAULT 'full'",
+    "priority": "INTEGER NOT NULL DEFAULT 0",
+    "preview": "INTEGER NOT NULL DEFAULT 0",
+    "excerpt_start": "REAL",
+    "stems": "TEXT",
+    "stage_times": "TEXT",
+    "peak_rss": "INTEGER",
+    "profiling": "INTEGER NOT NULL DEFAULT 0",
+    "lease_expires_at": "REAL",
+    "attempts": "INTEGER NOT NULL DEFAULT 0",
+}
+
+
+def join_stems(stems):
+    # stems column of a job, NULL for all of them
+    return ",".join(sorted(stems)) if stems else None
+
+
+# persistent queue of separation jobs shared by the app and the workers
+class JobQueue:
+    def __init__(self, db_path=JOBS_DB):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with connect(self.db_path) as conn:
+            set_journal_mode(conn)
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    song TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    file_path TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    progress REAL NOT NULL DEFAULT 0,
+                    profile TEXT NOT NULL DEFAULT 'full',
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    preview INTEGER NOT NULL DEFAULT 0,
+                    excerpt_start REAL,
+                    stems TEXT,
+                    stage_times TEXT,
+                    peak_rss INTEGER,
+                    profiling INTEGER NOT NULL DEFAULT 0,
+                    lease_expires_at REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    worker TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+                """
+            )
+            self._add_missing_columns(conn)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_song_model ON jobs (song, model)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status_priority"
+                " ON jobs (status, priority DESC, id)"
+            )
+
+    def _add_missing_columns(self, conn):
+        # columns added after the table was first created
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for column, definition in MIGRATED_COLUMNS.items():
+            if column not in columns:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front so that concurrent
+        # workers can't claim the same job
+        with connect(self.db_path) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def submit(
+        self,
+        song: str,
+        model: str,
+        file_path: str,
+        profile=DEFAULT_PROFILE,
+        priority=BULK_PRIORITY,
+        preview=False,
+        excerpt_start=None,
+        stems=None,
+        profiling=False,
+    ) -> int:
+        # identical (song, model, profile, preview, stems) submissions share
+        # the job already in flight, which takes the highest of their
+        # priorities and is profiled if any of them asks for it. stems is a
+        # subset of the model's stems, all by default
+        stems = join_stems(stems)
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE song = ? AND model = ? AND profile = ?"
+                " AND preview = ? AND stems IS ? AND status IN (?, ?)"
+                " ORDER BY id DESC LIMIT 1",
+                (song, model, profile, int(preview), stems, *ACTIVE_STATES),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET priority = MAX(priority, ?),"
+                    " profiling = MAX(profiling, ?) WHERE id = ?",
+                    (priority, int(profiling), row["id"]),
+                )
+                return row["id"]
+            return conn.execute(
+                "INSERT INTO jobs (song, model, profile, priority, preview,"
+                " excerpt_start, stems, profiling, file_path, status, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    song,
+                    model,
+                    profile,
+                    priority,
+                    int(preview),
+                    excerpt_start,
+                    stems,
+                    int(profiling),
+                    file_path,
+                    QUEUED,
+                    time.time(),
+                ),
+            ).lastrowid
+
+    def claim(self, worker: str):
+        # atomically move the oldest of the highest priority queued jobs to
+        # running, under a lease the worker renews while it runs the job.
+        # Jobs whose lease expired, their worker having died, are queued
+        # again first, or failed after MAX_ATTEMPTS
+        now = time.time()
+        expired = "status = ? AND (lease_expires_at IS NULL OR lease_expires_at < ?)"
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ?,"
+                f" lease_expires_at = NULL WHERE {expired} AND attempts >= ?",
+                (
+                    FAILED,
+                    f"Worker lost {MAX_ATTEMPTS} times",
+                    now,
+                    RUNNING,
+                    now,
+                    MAX_ATTEMPTS,
+                ),
+            )
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker = NULL, started_at = NULL"
+                f" WHERE {expired}",
+                (QUEUED, RUNNING, now),
+            )
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = ?"
+                " ORDER BY priority DESC, id LIMIT 1",
+                (QUEUED,),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, worker = ?, started_at = ?, progress = 0,"
+                    " lease_expires_at = ?, attempts = attempts + 1 WHERE id = ?",
+                    (RUNNING, worker, now, now + LEASE_SECONDS, row["id"]),
+                )
+        return dict(row) if row is not None else None
+
+    def renew(self, job_id: int, worker: str) -> bool:
+        # False if the lease expired and the job was queued again
+        with connect(self.db_path, timeout=RENEW_TIMEOUT_SECONDS) as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires_at = ?"
+                " WHERE id = ? AND worker = ? AND status = ?",
+                (time.time() + LEASE_SECONDS, job_id, worker, RUNNING),
+            )
+        if cursor.rowcount == 0:
+            log_event("job_lease_lost", job_id=job_id, worker=worker)
+            return False
+        return True
+
+    def set_progress(self, job_id: int, progress: float):
+        with connect(self.db_path) as conn:
+            conn.execute(
+                "UPDATE jobs SET progress = ? WHERE id = ?", (progress, job_id)
+            )
+
+    def finish(
+        self,
+        job_id: int,
+        error: str = None,
+        stage_times=None,
+        peak_rss=None,
+        worker=None,
+    ):
+        # a worker only finishes the jobs it still holds the lease of
+        with connect(self.db_path) as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ?,"
+                " stage_times = ?, peak_rss = ?, lease_expires_at = NULL"
+                " WHERE id = ? AND (? IS NULL OR worker = ?)",
+                (
+                    FAILED if error else DONE,
+                    error,
+                    time.time(),
+                    json.dumps(stage_times) if stage_times is not None else None,
+                    peak_rss,
+                    job_id,
+                    worker,
+                    worker,
+                ),
+            )
+
+    def get(self, job_id: int):
+        with connect(self.db_path) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def find(
+        self,
+        song: str,
+        model: str,
+        profile=DEFAULT_PROFILE,
+        preview=False,
+        stems=None,
+    ):
+        # latest job for a (song, model, profile, preview, stems), whatever
+        # its state
+        with connect(self.db_path) as conn:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE song = ? AND model = ? AND profile = ?"
+                " AND preview = ? AND stems IS ? ORDER BY id DESC LIMIT 1",
+                (song, model, profile, int(preview), join_stems(stems)),
+            ).fetchone()
+        return dict(row) if row is not None else None
+
+    def samples(self) -> list:
+        # queue depth, active jobs and the stage times and peak memory of the
+        # finished jobs, as metrics samples (see metrics.render_metrics)
+        with connect(self.db_path) as conn:
+            counts = {
+                row["status"]: row["count"]
+                for row in conn.execute(
+                    "SELECT status, COUNT(*) AS count FROM jobs GROUP BY status"
+                )
+            }
+            stages = conn.execute(
+                "SELECT stage.key AS stage, SUM(stage.value) AS seconds,"
+                " COUNT(*) AS runs FROM jobs, json_each(jobs.stage_times) AS stage"
+                " GROUP BY stage.key"
+            ).fetchall()
+            finished = conn.execute(
+                "SELECT MAX(peak_rss) AS peak_rss,"
+                " SUM(finished_at - started_at) AS seconds FROM jobs"
+                " WHERE status IN (?, ?)",
+                (DONE, FAILED),
+            ).fetchone()
+            last = conn.execute(
+                "SELECT peak_rss FROM jobs WHERE peak_rss IS NOT NULL"
+                " ORDER BY finished_at DESC LIMIT 1"
+            ).fetchone()
+        samples = [
+            ("jobs", "gauge", {"status": status}, counts.get(status, 0))
+            for status in (QUEUED, RUNNING, DONE, FAILED)
+        ]
+        samples += [
+            ("queue_depth", "gauge", {}, counts.get(QUEUED, 0)),
+            ("active_jobs", "gauge", {}, counts.get(RUNNING, 0)),
+            ("job_seconds_total", "counter", {}, finished["seconds"] or 0),
+            ("job_peak_rss_bytes_max", "gauge", {}, finished["peak_rss"] or 0),
+            ("job_peak_rss_bytes_last", "gauge", {}, last["peak_rss"] if last else 0),
+        ]
+        for row in stages:
+            samples.append(
+                (
+                    "job_stage_seconds_total",
+                    "counter",
+                    {"stage": row["stage"]},
+                    row["seconds"],
+                )
+            )
+            samples.append(
+                (
+                    "job_stage_runs_total",
+                    "counter",
+                    {"stage": row["stage"]},
+                    row["runs"],
+                )
+            )
+        return samples
+
+    def active_files(self) -> list:
+        # input files of the queued and running jobs
+        with connect(self.db_path) as conn:
+            return [
+                row["file_path"]
+                for row in conn.execute(
+                    "SELECT DISTINCT file_path FROM jobs WHERE status IN (?, ?)",
+                    ACTIVE_STATES,
+                )
+            ]
+
+
+def _worker_loop(db_path: str, output_path: str, ffmpeg_path=None, threads=0):
+    configure_threads(threads)
+    queue = JobQueue(db_path)
+    storage = StorageManager(StemStore(output_path), job_queue=queue)
+    worker = f"{os.uname().nodename}:{os.getpid()}"
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            time.sleep(POLL_INTERVAL_IN_SECONDS)
+            continue
+        progress = ProgressReporter(
+            lambda fraction, job_id=job["id"]: queue.set_progress(job_id, fraction)
+        )
+        stage_times = {}
+        error = None
+        reset_peak_rss()
+        start_time = time.perf_counter()
+        try:
+            with heartbeat(
+                lambda job_id=job["id"]: queue.renew(job_id, worker),
+                job_id=job["id"],
+                worker=worker,
+            ) as lease_lost:
+                separate_tracks(
+                    file_path=job["file_path"],
+                    output_path=output_path,
+                    ffmpeg_path=ffmpeg_path,
+                    model=job["model"],
+                    progress=progress,
+                    profile=job["profile"],
+                    preview=bool(job["preview"]),
+                    excerpt_start=job["excerpt_start"],
+                    stems=job["stems"].split(",") if job["stems"] else None,
+                    timings=stage_times,
+                    profiling=bool(job["profiling"]),
+                    storage=storage,
+                )
+        except Exception as e:
+            error = repr(e)
+        peak_rss = peak_rss_bytes()
+        queue.finish(
+            job["id"],
+            error=error,
+            stage_times=stage_times,
+            peak_rss=peak_rss,
+            worker=worker,
+        )
+        # no stage times means the stems were already in the store
+        log_event(
+            "job_failed" if error else "job_done",
+            job_id=job["id"],
+            song=job["song"],
+            model=job["model"],
+            profile=job["profile"],
+            preview=bool(job["preview"]),
+            worker=worker,
+            seconds=time.perf_counter() - start_time,
+            stage_times=stage_times,
+            peak_rss=peak_rss,
+            error=error,
+            lease_lost=lease_lost.is_set(),
+        )
+
+
+# separation worker processes, restarted when they die (e.g. killed for
+# running out of memory) so that queued jobs always have workers
+class WorkerPool:
+    def __init__(self, target, args: tuple, num_workers: int):
+        # spawn so that workers don't inherit the Streamlit server state
+        self.ctx = multiprocessing.get_context("spawn")
+        self.target = target
+        self.args = args
+        self.stopping = threading.Event()
+        self.processes = [self._start() for _ in range(num_workers)]
+        threading.Thread(target=self._supervise, daemon=True).start()
+        atexit.register(self.stop)
+
+    def _start(self):
+        process = self.ctx.Process(target=self.target, args=self.args)
+        process.start()
+        return process
+
+    def _supervise(self):
+        while not self.stopping.wait(WORKER_CHECK_SECONDS):
+            for i, process in enumerate(self.processes):
+                if not process.is_alive() and not self.stopping.is_set():
+                    log_event(
+                        "worker_restarted", pid=process.pid, exitcode=process.exitcode
+                    )
+                    self.processes[i] = self._start()
+
+    def stop(self):
+        self.stopping.set()
+        for process in self.processes:
+            process.terminate()
+
+
+def start_workers(
+    output_path: str,
+    ffmpeg_path=None,
+    num_workers=NUM_WORKERS,
+    db_path=JOBS_DB,
+) -> WorkerPool:
+    # workers are not daemonic so they can run their own segment pool (see
+    # engine.PARALLEL_WORKERS), they are terminated when the server exits.
+    # The cores are shared between the workers instead of each of them
+    # running one torch thread per core
+    threads = INFERENCE_THREADS or max((os.cpu_count() or 1) // num_workers, 1)
+    return WorkerPool(
+        _worker_loop, (db_path, output_path, ffmpeg_path, threads), num_workers
+    )
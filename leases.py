@@ -0,0 +1,140 @@
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+from db import connect, set_journal_mode
+from metrics import log_event
+
+LEASES_DB = "leases.db"
+# a lease not renewed for this long is considered abandoned, holders renew
+# theirs every HEARTBEAT_SECONDS for as long as they work
+LEASE_SECONDS = float(os.environ.get("LEASE_SECONDS", 30))
+HEARTBEAT_SECONDS = LEASE_SECONDS / 3
+LEASE_POLL_SECONDS = 1
+# renewals give up on a locked database well before the next one is due,
+# instead of waiting out the lease
+RENEW_TIMEOUT_SECONDS = HEARTBEAT_SECONDS / 4
+
+
+def holder_id() -> str:
+    # unique across the replicas sharing the volume
+    return f"{os.uname().nodename}:{os.getpid()}:{threading.get_ident()}"
+
+
+@contextlib.contextmanager
+def heartbeat(renew, interval=HEARTBEAT_SECONDS, lease_seconds=LEASE_SECONDS, **labels):
+    # calls renew every interval seconds while the block runs. Yields an
+    # event set once the lease is lost, renew having returned False or failed
+    # until the lease may expire before the next renewal: the block must then
+    # not commit its results, another holder may be computing them
+    stop = threading.Event()
+    lost = threading.Event()
+
+    def beat():
+        renewed_at = time.monotonic()
+        while not stop.wait(interval):
+            try:
+                if not renew():
+                    lost.set()
+                    return
+                renewed_at = time.monotonic()
+            except sqlite3.Error as e:
+                log_event("lease_renew_failed", error=repr(e), **labels)
+                if time.monotonic() - renewed_at + interval >= lease_seconds:
+                    lost.set()
+                    return
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield lost
+    finally:
+        stop.set()
+        thread.join()
+
+
+# leases on keys held by one holder at a time, in a database on the volume
+# shared by the replicas. A lease is taken over once it expires, so a crashed
+# holder blocks the others for at most LEASE_SECONDS, while a live one keeps
+# its lease for as long as it needs by renewing it. Expiry times are written
+# with the clock of each host, which must be kept in sync (e.g. NTP) well
+# within LEASE_SECONDS
+class LeaseLock:
+    def __init__(self, db_path: str, lease_seconds=LEASE_SECONDS):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with connect(self.db_path) as conn:
+            set_journal_mode(conn)
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS leases (
+                    key TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL,
+                    acquired_at REAL NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+                """
+            )
+
+    def acquire(self, key: str, holder: str) -> bool:
+        # a single statement, so that two holders can't both take the lease
+        now = time.time()
+        with connect(self.db_path) as conn:
+            cursor = conn.execute(
+                "INSERT INTO leases (key, holder, acquired_at, expires_at)"
+                " VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (key) DO UPDATE SET holder = excluded.holder,"
+                " acquired_at = excluded.acquired_at,"
+                " expires_at = excluded.expires_at"
+                " WHERE expires_at < ? OR holder = excluded.holder",
+                (key, holder, now, now + self.lease_seconds, now),
+            )
+            return cursor.rowcount > 0
+
+    def renew(self, key: str, holder: str) -> bool:
+        # False if the lease expired and was taken over
+        with connect(self.db_path, timeout=RENEW_TIMEOUT_SECONDS) as conn:
+            cursor = conn.execute(
+                "UPDATE leases SET expires_at = ? WHERE key = ? AND holder = ?",
+                (time.time() + self.lease_seconds, key, holder),
+            )
+        if cursor.rowcount == 0:
+            log_event("lease_lost", key=key, holder=holder)
+            return False
+        return True
+
+    def release(self, key: str, holder: str):
+        with connect(self.db_path) as conn:
+            conn.execute(
+                "DELETE FROM leases WHERE key = ? AND holder = ?", (key, holder)
+            )
+
+    def holder(self, key: str):
+        # holder of a live lease on key, None if there is none
+        with connect(self.db_path) as conn:
+            row = conn.execute(
+                "SELECT holder FROM leases WHERE key = ? AND expires_at >= ?",
+                (key, time.time()),
+            ).fetchone()
+        return row["holder"] if row is not None else None
+
+    @contextlib.contextmanager
+    def hold(self, key: str, holder=None):
+        # waits for the lease on key, and renews it while the block runs.
+        # Yields the event set if the lease is lost, see heartbeat
+        holder = holder or holder_id()
+        while not self.acquire(key, holder):
+            time.sleep(LEASE_POLL_SECONDS)
+        try:
+            with heartbeat(
+                lambda: self.renew(key, holder),
+                lease_seconds=self.lease_seconds,
+                key=key,
+                holder=holder,
+            ) as lost:
+                yield lost
+        finally:
+            self.release(key, holder)
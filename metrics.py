@@ -0,0 +1,102 @@
+import contextlib
+import json
+import logging
+import os
+import resource
+import threading
+import time
+
+METRICS_PREFIX = "track_splitter"
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+
+# one JSON object per line, to be read by a log collector
+logger = logging.getLogger("track_splitter")
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+
+def log_event(event: str, **fields):
+    logger.info(json.dumps({"time": time.time(), "event": event, **fields}))
+
+
+def reset_peak_rss():
+    # resets the peak RSS of this process (Linux), so that it can be
+    # measured per job instead of over the life of the worker
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_bytes() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux, and never reset
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# counters of this process, keyed by name and labels
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value=1.0, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0.0) + value
+
+    @contextlib.contextmanager
+    def timed(self, stage: str, **labels):
+        # seconds spent and number of runs of a stage
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.inc("stage_seconds_total", seconds, stage=stage, **labels)
+            self.inc("stage_runs_total", stage=stage, **labels)
+
+    def samples(self) -> list:
+        with self.lock:
+            return [
+                (name, "counter", dict(labels), value)
+                for (name, labels), value in self.counters.items()
+            ]
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_metrics(samples: list) -> str:
+    # Prometheus text exposition format of (name, type, labels, value) samples
+    lines = []
+    typed = set()
+    for name, metric_type, labels, value in sorted(
+        samples, key=lambda sample: (sample[0], sorted(sample[2].items()))
+    ):
+        name = f"{METRICS_PREFIX}_{name}"
+        if name not in typed:
+            lines.append(f"# TYPE {name} {metric_type}")
+            typed.add(name)
+        if labels:
+            label_text = ",".join(
+                f'{key}="{escape_label(label)}"' for key, label in labels.items()
+            )
+            name = f"{name}{{{label_text}}}"
+        lines.append(f"{name} {float(value)!r}")
+    return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
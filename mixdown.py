@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from encoder import encode_pcm
+from metrics import metrics
+from pcm_cache import CHANNELS, SAMPLERATE
+from stem_store import StemStore
+
+MIX_BLOCK_SECONDS = 10
+
+PRESETS = {
+    "Karaoke (no vocals)": {"vocals": 0.0},
+    "Vocals only": {"vocals": 1.0, "*": 0.0},
+    "Drums + bass": {"drums": 1.0, "bass": 1.0, "*": 0.0},
+}
+
+
+def preset_gains(preset: str, stems: list) -> dict:
+    # "*" is the gain of the stems the preset doesn't name, 1 by default
+    gains = PRESETS[preset]
+    return {stem: gains.get(stem, gains.get("*", 1.0)) for stem in stems}
+
+
+def mix_key(gains: dict, start: float, end: float) -> str:
+    # gains are rounded so that slider noise doesn't defeat the cache
+    key = {
+        "gains": {stem: round(gain, 2) for stem, gain in sorted(gains.items())},
+        "start": round(start, 2),
+        "end": None if end is None else round(end, 2),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def mix_stems(stem_paths: dict, gains: dict, pcm_path: str, start=0.0, end=None):
+    # weighted sum of the memory-mapped stems over [start, end), block by
+    # block, written as canonical PCM
+    stems = list(stem_paths)
+    arrays = [
+        np.memmap(stem_paths[stem], dtype=np.float32, mode="r").reshape(-1, CHANNELS)
+        for stem in stems
+    ]
+    weights = np.array([gains.get(stem, 1.0) for stem in stems], dtype=np.float32)
+    length = min(len(array) for array in arrays)
+    first = min(int(start * SAMPLERATE), length)
+    last = length if end is None else min(int(end * SAMPLERATE), length)
+    # stems muted by the mix are never read
+    used = np.flatnonzero(weights)
+    block = int(MIX_BLOCK_SECONDS * SAMPLERATE)
+    with open(pcm_path, "wb") as f:
+        for offset in range(first, last, block):
+            block_end = min(offset + block, last)
+            if len(used):
+                blocks = np.stack([arrays[i][offset:block_end] for i in used])
+                mixed = np.tensordot(weights[used], blocks, axes=1)
+                np.clip(mixed, -1.0, 1.0, out=mixed)
+            else:
+                mixed = np.zeros((block_end - offset, CHANNELS), dtype=np.float32)
+            f.write(mixed.astype(np.float32, copy=False).tobytes())
+
+
+# renders mixes of the stems of a song, cached by (song hash, model, gains,
+# region, format, bitrate) under {root}/{model}/{audio hash}/mix/
+class Mixer:
+    def __init__(self, store: StemStore):
+        self.store = store
+
+    def mix_path(
+        self,
+        audio_hash: str,
+        model: str,
+        gains: dict,
+        start: float,
+        end: float,
+        output_format: str,
+        bitrate: int,
+    ) -> str:
+        return os.path.join(
+            self.store.root,
+            model,
+            audio_hash,
+            "mix",
+            f"{mix_key(gains, start, end)}_{bitrate}.{output_format}",
+        )
+
+    def render(
+        self,
+        audio_hash: str,
+        model: str,
+        gains: dict,
+        start=0.0,
+        end=None,
+        output_format="mp3",
+        bitrate=192,
+    ) -> str:
+        output_path = self.mix_path(
+            audio_hash, model, gains, start, end, output_format, bitrate
+        )
+        if os.path.exists(output_path):
+            metrics.inc("mixdown_requests_total", result="hit")
+            return output_path
+        metrics.inc("mixdown_requests_total", result="miss")
+        stem_paths = self.store.lookup(audio_hash, model)
+        if stem_paths is None:
+            raise FileNotFoundError(f"No stems for {audio_hash} with {model}")
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        pcm_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.f32"
+        try:
+            with metrics.timed("mixdown", format=output_format):
+                mix_stems(stem_paths, gains, pcm_path, start, end)
+                encode_pcm(pcm_path, output_path, output_format, bitrate)
+        finally:
+            if os.path.exists(pcm_path):
+                os.remove(pcm_path)
+        return output_path
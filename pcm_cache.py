@@ -0,0 +1,62 @@
+import os
+import subprocess
+import threading
+
+import numpy as np
+
+# canonical decoded format, the one the demucs models are trained on
+SAMPLERATE = 44100
+CHANNELS = 2
+
+
+def decode_to_pcm(file_path: str, pcm_path: str):
+    # decodes straight to disk so that memory doesn't grow with the track length
+    tmp_path = f"{pcm_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-y",
+            "-loglevel",
+            "error",
+            "-i",
+            file_path,
+            "-map",
+            "0:a:0",
+            "-f",
+            "f32le",
+            "-ac",
+            str(CHANNELS),
+            "-ar",
+            str(SAMPLERATE),
+            tmp_path,
+        ],
+        check=True,
+    )
+    os.replace(tmp_path, pcm_path)
+
+
+# inputs decoded once to raw float32 PCM, {root}/{audio hash}.f32, and read
+# back memory-mapped by every separation of the song
+class PcmCache:
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, audio_hash: str) -> str:
+        return os.path.join(self.root, f"{audio_hash}.f32")
+
+    def decode(self, file_path: str, audio_hash: str) -> str:
+        pcm_path = self.path(audio_hash)
+        if not os.path.exists(pcm_path):
+            decode_to_pcm(file_path, pcm_path)
+        return pcm_path
+
+    def load(self, file_path: str, audio_hash: str):
+        # [channels, samples] tensor backed by the memory-mapped file
+        import torch
+
+        pcm_path = self.decode(file_path, audio_hash)
+        # copy-on-write, so that torch gets a writable array without the
+        # file ever being modified
+        pcm = np.memmap(pcm_path, dtype=np.float32, mode="c")
+        return torch.from_numpy(pcm.reshape(-1, CHANNELS)).t()
@@ -0,0 +1,81 @@
+import json
+import os
+
+import numpy as np
+
+# (min, max) pairs kept per stem, enough for a full-width waveform
+PEAK_BINS = 1000
+PEAKS_FILE = "peaks.json"
+# peaks are stored as 8-bit integers, full scale being 127
+PEAK_SCALE = 127
+
+
+def samples_per_peak(length: int, bins=PEAK_BINS) -> int:
+    return max(-(-length // bins), 1)
+
+
+# min/max envelope of a stem, fed with the [samples, channels] blocks written
+# to disk so that the stem is never read back
+class PeakAccumulator:
+    def __init__(self, samples_per_peak: int):
+        self.samples_per_peak = samples_per_peak
+        self.samples = 0
+        self.lows = []
+        self.highs = []
+        # samples of the last, incomplete bin, carried to the next block
+        self.low_rest = np.zeros(0, dtype=np.float32)
+        self.high_rest = np.zeros(0, dtype=np.float32)
+
+    def add(self, data):
+        self.samples += len(data)
+        low = np.concatenate([self.low_rest, data.min(axis=1)])
+        high = np.concatenate([self.high_rest, data.max(axis=1)])
+        full = len(low) // self.samples_per_peak * self.samples_per_peak
+        self.lows.append(low[:full].reshape(-1, self.samples_per_peak).min(axis=1))
+        self.highs.append(high[:full].reshape(-1, self.samples_per_peak).max(axis=1))
+        self.low_rest, self.high_rest = low[full:], high[full:]
+
+    def envelope(self):
+        lows, highs = list(self.lows), list(self.highs)
+        if len(self.low_rest):
+            lows.append(self.low_rest.min(keepdims=True))
+            highs.append(self.high_rest.max(keepdims=True))
+        if not lows:
+            return np.zeros(0), np.zeros(0)
+        return np.concatenate(lows), np.concatenate(highs)
+
+
+def quantize(peaks):
+    return np.round(np.clip(peaks, -1.0, 1.0) * PEAK_SCALE).astype(np.int8).tolist()
+
+
+def write_peaks(output_dir: str, samplerate: int, accumulators: dict):
+    # sidecar index of the stems in output_dir: exact length and the
+    # envelopes the player draws
+    samples = min(
+        (accumulator.samples for accumulator in accumulators.values()), default=0
+    )
+    index = {
+        "samplerate": samplerate,
+        "samples": samples,
+        "duration": samples / samplerate,
+        "stems": {},
+    }
+    for stem, accumulator in accumulators.items():
+        lows, highs = accumulator.envelope()
+        index["samples_per_peak"] = accumulator.samples_per_peak
+        index["stems"][stem] = {"min": quantize(lows), "max": quantize(highs)}
+    path = os.path.join(output_dir, PEAKS_FILE)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def read_peaks(output_dir: str):
+    # None for stems separated before peaks were recorded
+    path = os.path.join(output_dir, PEAKS_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,31 @@
+from pcm_cache import SAMPLERATE
+
+PREVIEW_SECONDS = 30
+# the song is scanned this many seconds at a time for its loudest part
+ENERGY_BLOCK_SECONDS = 60
+
+
+def preview_model(stored_model: str) -> str:
+    # previews are stored apart from the full stems, as {model}-preview
+    return f"{stored_model}-preview"
+
+
+def loudest_excerpt(wav, seconds=PREVIEW_SECONDS) -> int:
+    # first sample of the loudest window of the song, a cheap stand-in for
+    # the chorus. wav is read block by block so that memory doesn't grow with
+    # the song length
+    import torch
+
+    total_seconds = wav.shape[-1] // SAMPLERATE
+    if total_seconds <= seconds:
+        return 0
+    energy = []
+    for start in range(0, total_seconds, ENERGY_BLOCK_SECONDS):
+        end = min(start + ENERGY_BLOCK_SECONDS, total_seconds)
+        block = wav[..., start * SAMPLERATE : end * SAMPLERATE]
+        energy.append(block.reshape(block.shape[0], -1, SAMPLERATE).pow(2).sum((0, 2)))
+    cumulative = torch.cat(
+        [torch.zeros(1, dtype=torch.float64), torch.cat(energy).double().cumsum(0)]
+    )
+    windows = cumulative[seconds:] - cumulative[:-seconds]
+    return int(windows.argmax()) * SAMPLERATE
@@ -0,0 +1,57 @@
+import os
+
+# inference profiles, selectable per job. precision is float32, bfloat16
+# (autocast, used only where the CPU runs it natively) or int8 (dynamic
+# quantization of the linear and LSTM layers). shifts and overlap are passed
+# to demucs' apply_model, shifts=0 skipping the random shift and its padding
+INFERENCE_PROFILES = {
+    "full": {"precision": "float32", "shifts": 1, "overlap": 0.25},
+    "bf16": {"precision": "bfloat16", "shifts": 1, "overlap": 0.25},
+    "int8": {"precision": "int8", "shifts": 1, "overlap": 0.25},
+    "fast": {"precision": "bfloat16", "shifts": 0, "overlap": 0.1},
+}
+DEFAULT_PROFILE = os.environ.get("INFERENCE_PROFILE", "full")
+# torch threads of each separation worker, 0 for torch's default
+INFERENCE_THREADS = int(os.environ.get("INFERENCE_THREADS", 0))
+INTEROP_THREADS = int(os.environ.get("INTEROP_THREADS", 1))
+# the stems left out of a stem subset are written summed as one
+RESIDUAL_STEM = "accompaniment"
+
+
+def store_model(model: str, profile: str, stems=None) -> str:
+    # stems of reduced precision profiles and of stem subsets are stored apart
+    # from the full ones, as {model}-{profile}-{stem}+{stem}
+    name = model if profile == "full" else f"{model}-{profile}"
+    if stems:
+        name += "-" + "+".join(sorted(stems))
+    return name
+
+
+def output_stems(model_stems: list, stems=None) -> list:
+    # the stems written when only stems are asked for, all of them by default
+    unknown = set(stems or []) - set(model_stems)
+    if unknown:
+        raise ValueError(f"Unknown stems {', '.join(sorted(unknown))}")
+    if not stems or set(stems) == set(model_stems):
+        return list(model_stems)
+    return [stem for stem in model_stems if stem in stems] + [RESIDUAL_STEM]
+
+
+def configure_threads(threads=INFERENCE_THREADS, interop_threads=INTEROP_THREADS):
+    # to be called before torch runs anything, interop threads can't be
+    # changed afterwards
+    import torch
+
+    if threads:
+        torch.set_num_threads(threads)
+    torch.set_num_interop_threads(interop_threads)
+
+
+def bfloat16_supported() -> bool:
+    # without native support bfloat16 is emulated and slower than float32
+    import torch
+
+    return any(
+        getattr(torch.cpu, check, lambda: False)()
+        for check in ("_is_avx512_bf16_supported", "_is_amx_tile_supported")
+    )
@@ -0,0 +1,103 @@
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+
+# artifacts of a profiled separation, written next to its stems
+PROFILE_FILE = "profile.json"
+PSTATS_FILE = "profile.pstats"
+TORCH_OPS_FILE = "torch_ops.txt"
+TOP_FUNCTIONS = 20
+
+
+def hot_functions(stats: pstats.Stats, limit=TOP_FUNCTIONS) -> list:
+    # the functions the most time was spent in, callees included
+    functions = []
+    for (file_name, line, name), (_, calls, own, cumulative, _) in stats.stats.items():
+        functions.append(
+            {
+                "function": f"{name} ({os.path.basename(file_name)}:{line})",
+                "calls": calls,
+                "own_seconds": own,
+                "cumulative_seconds": cumulative,
+            }
+        )
+    functions.sort(key=lambda function: function["cumulative_seconds"], reverse=True)
+    return functions[:limit]
+
+
+def hot_operators(profiler, limit=TOP_FUNCTIONS) -> list:
+    # the torch operators the most CPU time was spent in, callees excluded
+    events = sorted(
+        profiler.key_averages(), key=lambda event: event.self_cpu_time_total
+    )
+    return [
+        {
+            "operator": event.key,
+            "calls": event.count,
+            "own_seconds": event.self_cpu_time_total / 1e6,
+            "cumulative_seconds": event.cpu_time_total / 1e6,
+        }
+        for event in reversed(events[-limit:])
+    ]
+
+
+@contextlib.contextmanager
+def profile_run(output_dir: str):
+    # call profile and torch operator profile of the block, saved to
+    # output_dir once it completes. With parallel segments the inference runs
+    # in the pool's processes and only shows up as waiting on them
+    import torch
+
+    call_profiler = cProfile.Profile()
+    with torch.profiler.profile(
+        activities=[torch.profiler.ProfilerActivity.CPU]
+    ) as torch_profiler:
+        call_profiler.enable()
+        try:
+            yield
+        finally:
+            call_profiler.disable()
+    stats = pstats.Stats(call_profiler)
+    os.makedirs(output_dir, exist_ok=True)
+    stats.dump_stats(os.path.join(output_dir, PSTATS_FILE))
+    with open(os.path.join(output_dir, TORCH_OPS_FILE), "w") as f:
+        f.write(
+            torch_profiler.key_averages().table(
+                sort_by="self_cpu_time_total", row_limit=TOP_FUNCTIONS * 2
+            )
+        )
+    summary = {
+        "total_seconds": stats.total_tt,
+        "functions": hot_functions(stats),
+        "operators": hot_operators(torch_profiler),
+    }
+    tmp_path = os.path.join(output_dir, f".{PROFILE_FILE}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(summary, f)
+    os.replace(tmp_path, os.path.join(output_dir, PROFILE_FILE))
+
+
+def read_profile(output_dir: str):
+    # summary of the profile saved in output_dir, None if it wasn't profiled
+    try:
+        with open(os.path.join(output_dir, PROFILE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def format_profile(summary: dict, limit=10) -> str:
+    lines = [f"profiled {summary['total_seconds']:.2f}s"]
+    for title, rows, key in (
+        ("functions", summary["functions"], "function"),
+        ("torch operators", summary["operators"], "operator"),
+    ):
+        lines.append(f"  top {title}:")
+        lines += [
+            f"    {row['cumulative_seconds']:8.2f}s {row['own_seconds']:8.2f}s"
+            f" {row['calls']:>8}  {row[key]}"
+            for row in rows[:limit]
+        ]
+    return "\n".join(lines)
@@ -0,0 +1,31 @@
+import time
+
+PROGRESS_INTERVAL_IN_SECONDS = 0.5
+
+
+# per-job progress channel: the engine calls it with the fraction done, and
+# it forwards at most one update per interval to the sink (e.g. the job row
+# read by the UI), so reporting stays out of the hot loop
+class ProgressReporter:
+    def __init__(self, sink, min_interval=PROGRESS_INTERVAL_IN_SECONDS):
+        self.sink = sink
+        self.min_interval = min_interval
+        self.last_update = float("-inf")
+        self.fraction = 0.0
+
+    def __call__(self, fraction: float):
+        fraction = min(max(fraction, self.fraction), 1.0)
+        now = time.monotonic()
+        if fraction < 1.0 and now - self.last_update < self.min_interval:
+            return
+        self.last_update = now
+        self.fraction = fraction
+        self.sink(fraction)
+
+
+def scaled_progress(progress, start: float, end: float):
+    # progress callback for a sub-task covering [start, end] of the job
+    def report(fraction: float):
+        progress(start + fraction * (end - start))
+
+    return report
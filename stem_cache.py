@@ -0,0 +1,62 @@
+import os
+import threading
+from collections import OrderedDict
+
+STEM_CACHE_BYTES = int(os.environ.get("STEM_CACHE_BYTES", 256 * 1024**2))
+
+
+# LRU cache of stem file contents bounded by a byte budget; entries are
+# invalidated when the file's size or mtime changes
+class StemCache:
+    def __init__(self, max_bytes=STEM_CACHE_BYTES, max_item_bytes=None):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes or max_bytes // 4
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def read(self, path: str) -> bytes:
+        stat = os.stat(path)
+        version = (stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            if entry is not None:
+                self._discard(path)
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) <= self.max_item_bytes:
+            with self.lock:
+                if path in self.entries:
+                    self._discard(path)
+                self.entries[path] = (version, data)
+                self.size += len(data)
+                while self.size > self.max_bytes:
+                    self._discard(next(iter(self.entries)))
+                    self.evictions += 1
+        return data
+
+    def _discard(self, path: str):
+        _, data = self.entries.pop(path)
+        self.size -= len(data)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+stem_cache = StemCache()
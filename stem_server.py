@@ -0,0 +1,184 @@
+import json
+import mimetypes
+import os
+import re
+import subprocess
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from metrics import metrics, render_metrics
+from stem_cache import stem_cache
+from stem_store import STORE_DIR
+
+STEM_SERVER_PORT = int(os.environ.get("STEM_SERVER_PORT", 8502))
+# public address of the server as seen by the browser, e.g. behind a proxy
+STEM_SERVER_URL = os.environ.get(
+    "STEM_SERVER_URL", f"http://localhost:{STEM_SERVER_PORT}"
+)
+COPY_CHUNK_SIZE = 64 * 1024
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+def stem_url(stem_path: str, root=STORE_DIR) -> str:
+    return f"{STEM_SERVER_URL}/{urllib.parse.quote(os.path.relpath(stem_path, root))}"
+
+
+# serves the audio files of the stem store with HTTP Range support, so the
+# browser can stream and seek stems instead of downloading them upfront
+class StemRequestHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/stats":
+            self.serve_stats()
+            return
+        if path == "/metrics":
+            self.serve_metrics()
+            return
+        self.serve(send_body=True)
+
+    def serve_stats(self):
+        body = json.dumps({"stem_cache": stem_cache.stats()}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def serve_metrics(self):
+        # counters of the app process, and the queue and the per stage times
+        # of the separation jobs as recorded by the workers in the jobs db
+        samples = metrics.samples()
+        samples += [
+            (
+                f"stem_cache_{name}",
+                "counter" if name in ("hits", "misses", "evictions") else "gauge",
+                {},
+                value,
+            )
+            for name, value in stem_cache.stats().items()
+        ]
+        if self.server.job_queue is not None:
+            samples += self.server.job_queue.samples()
+        body = render_metrics(samples).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def resolve(self):
+        url_path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        root = os.path.realpath(self.server.root)
+        path = os.path.realpath(os.path.join(root, url_path.lstrip("/")))
+        content_type = mimetypes.guess_type(path)[0] or ""
+        # only audio files below the store root, never the manifest or jobs db
+        if not path.startswith(root + os.sep) or not content_type.startswith("audio/"):
+            return None, None
+        if not os.path.isfile(path) and not self.encode(path):
+            return None, None
+        return path, content_type
+
+    def encode(self, path: str) -> bool:
+        # encoded variants are produced the first time they are requested
+        encoder = self.server.encoder
+        variant = encoder.store.parse_stem_path(path) if encoder else None
+        if variant is None:
+            return False
+        audio_hash, model, stem, output_format, bitrate = variant
+        if not os.path.exists(encoder.store.stem_path(audio_hash, model, stem)):
+            return False
+        try:
+            encoder.encode(audio_hash, model, stem, output_format, bitrate)
+        except (ValueError, subprocess.CalledProcessError):
+            return False
+        return True
+
+    def serve(self, send_body: bool):
+        with metrics.timed("serve"):
+            status = self._serve(send_body)
+        metrics.inc("stem_requests_total", status=status)
+
+    def _serve(self, send_body: bool) -> int:
+        path, content_type = self.resolve()
+        if path is None:
+            self.send_error(404)
+            return 404
+        with open(path, "rb") as f:
+            # small stems are served from the cache, the others are streamed
+            # from disk so that memory doesn't grow with the stem length.
+            # Content-Length is taken from what is actually served
+            data = None
+            size = os.fstat(f.fileno()).st_size
+            if size <= stem_cache.max_item_bytes:
+                data = memoryview(stem_cache.read(path))
+                size = len(data)
+            start, end = 0, size - 1
+            range_header = self.headers.get("Range")
+            if range_header:
+                match = RANGE_PATTERN.match(range_header.strip())
+                if match and match[1]:
+                    start = int(match[1])
+                    end = min(int(match[2]), size - 1) if match[2] else size - 1
+                elif match and match[2]:
+                    # suffix range, the last N bytes
+                    start = max(size - int(match[2]), 0)
+                if not match or not (match[1] or match[2]) or start > end:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return 416
+                status = 206
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            else:
+                status = 200
+                self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            # stems are content addressed, a path never changes content
+            self.send_header("Cache-Control", "public, max-age=31536000, immutable")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            if not send_body:
+                return status
+            try:
+                if data is not None:
+                    for offset in range(start, end + 1, COPY_CHUNK_SIZE):
+                        chunk = data[offset : min(offset + COPY_CHUNK_SIZE, end + 1)]
+                        self.wfile.write(chunk)
+                        metrics.inc("stem_served_bytes_total", len(chunk))
+                else:
+                    f.seek(start)
+                    remaining = end - start + 1
+                    while remaining > 0:
+                        chunk = f.read(min(COPY_CHUNK_SIZE, remaining))
+                        if not chunk:
+                            break
+                        self.wfile.write(chunk)
+                        remaining -= len(chunk)
+                        metrics.inc("stem_served_bytes_total", len(chunk))
+            except ConnectionError:
+                # the browser dropped the request, e.g. after seeking
+                pass
+        return status
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stem_server(
+    root=STORE_DIR, port=STEM_SERVER_PORT, encoder=None, job_queue=None
+):
+    server = ThreadingHTTPServer(("", port), StemRequestHandler)
+    server.daemon_threads = True
+    server.root = root
+    server.encoder = encoder
+    server.job_queue = job_queue
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
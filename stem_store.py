@@ -0,0 +1,280 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from db import connect, set_journal_mode
+
+STORE_DIR = "separated"
+MANIFEST_DB = "manifest.db"
+# separation writes stems once as raw float32 PCM, delivery formats are
+# encoded from it on demand
+CANONICAL_FORMAT = "f32"
+CANONICAL_BITRATE = 0
+OUTPUT_FORMAT = "mp3"
+OUTPUT_BITRATE = 192
+HASH_CHUNK_SIZE = 1024 * 1024
+# last access times are only updated once they are this many seconds old
+ACCESS_RESOLUTION = 60
+# model of the access times of a song's input files
+INPUT_ACCESS = ""
+
+
+def hash_file(file_path: str) -> str:
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+# stems are stored by content, under {root}/{model}/{audio hash}/{format}_{bitrate}/
+# (f32_0/ for the canonical PCM), with a manifest of the complete entries and
+# of the hashes of known inputs
+class StemStore:
+    def __init__(self, root=STORE_DIR):
+        self.root = root
+        self.db_path = os.path.join(root, MANIFEST_DB)
+        os.makedirs(root, exist_ok=True)
+        with connect(self.db_path) as conn:
+            set_journal_mode(conn)
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS inputs (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    hash TEXT NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    hash TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    format TEXT NOT NULL,
+                    bitrate INTEGER NOT NULL,
+                    stems TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (hash, model, format, bitrate)
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS access (
+                    hash TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    last_access REAL NOT NULL,
+                    PRIMARY KEY (hash, model)
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS inputs_hash ON inputs (hash)")
+
+    def cached_hash(self, file_path: str):
+        # hash of an input unchanged since it was last hashed, None otherwise
+        file_path = os.path.normpath(file_path)
+        stat = os.stat(file_path)
+        with connect(self.db_path) as conn:
+            row = conn.execute(
+                "SELECT hash FROM inputs WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (file_path, stat.st_size, stat.st_mtime_ns),
+            ).fetchone()
+        return row["hash"] if row is not None else None
+
+    def hash_song(self, file_path: str) -> str:
+        # only rehash inputs whose size or mtime changed since the last time
+        audio_hash = self.cached_hash(file_path)
+        if audio_hash is None:
+            audio_hash = hash_file(file_path)
+            self.record_input(file_path, audio_hash)
+        self.touch(audio_hash)
+        return audio_hash
+
+    def record_input(self, file_path: str, audio_hash: str):
+        # for inputs whose hash was computed as they were written
+        file_path = os.path.normpath(file_path)
+        stat = os.stat(file_path)
+        with connect(self.db_path) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO inputs (path, size, mtime_ns, hash) VALUES (?, ?, ?, ?)",
+                (file_path, stat.st_size, stat.st_mtime_ns, audio_hash),
+            )
+
+    def find_input(self, audio_hash: str, directory: str):
+        # an unchanged input of directory with this hash, None if there is none
+        directory = os.path.normpath(directory)
+        with connect(self.db_path) as conn:
+            rows = conn.execute(
+                "SELECT path, size, mtime_ns FROM inputs WHERE hash = ?",
+                (audio_hash,),
+            ).fetchall()
+        for row in rows:
+            if os.path.dirname(row["path"]) != directory:
+                continue
+            try:
+                stat = os.stat(row["path"])
+            except FileNotFoundError:
+                continue
+            if (stat.st_size, stat.st_mtime_ns) == (row["size"], row["mtime_ns"]):
+                return row["path"]
+        return None
+
+    def touch(self, audio_hash: str, model=INPUT_ACCESS):
+        # records an access to the stems of a song for a model, or to its
+        # input files, for the least recently used to be evicted first
+        now = time.time()
+        with connect(self.db_path) as conn:
+            conn.execute(
+                "INSERT INTO access (hash, model, last_access) VALUES (?, ?, ?)"
+                " ON CONFLICT (hash, model) DO UPDATE"
+                " SET last_access = excluded.last_access"
+                " WHERE last_access < excluded.last_access - ?",
+                (audio_hash, model, now, ACCESS_RESOLUTION),
+            )
+
+    def access_times(self) -> dict:
+        # {(audio hash, model): last access}
+        with connect(self.db_path) as conn:
+            return {
+                (row["hash"], row["model"]): row["last_access"]
+                for row in conn.execute("SELECT hash, model, last_access FROM access")
+            }
+
+    def stem_dir(
+        self,
+        audio_hash: str,
+        model: str,
+        output_format=CANONICAL_FORMAT,
+        bitrate=CANONICAL_BITRATE,
+    ) -> str:
+        return os.path.join(self.root, model, audio_hash, f"{output_format}_{bitrate}")
+
+    def stem_path(
+        self,
+        audio_hash: str,
+        model: str,
+        stem: str,
+        output_format=CANONICAL_FORMAT,
+        bitrate=CANONICAL_BITRATE,
+    ) -> str:
+        return os.path.join(
+            self.stem_dir(audio_hash, model, output_format, bitrate),
+            f"{stem}.{output_format}",
+        )
+
+    def staging_dir(
+        self,
+        audio_hash: str,
+        model: str,
+        output_format=CANONICAL_FORMAT,
+        bitrate=CANONICAL_BITRATE,
+    ) -> str:
+        # where stems are written before commit moves them into place, unique
+        # across the replicas sharing the store
+        stem_dir = self.stem_dir(audio_hash, model, output_format, bitrate)
+        return f"{stem_dir}.{os.uname().nodename}.{os.getpid()}.tmp"
+
+    def parse_stem_path(self, path: str):
+        # (audio hash, model, stem, format, bitrate) of a stem path
+        parts = os.path.relpath(path, self.root).split(os.sep)
+        if len(parts) != 4 or "_" not in parts[2]:
+            return None
+        model, audio_hash, variant, file_name = parts
+        output_format, bitrate = variant.rsplit("_", 1)
+        stem, ext = os.path.splitext(file_name)
+        if ext != f".{output_format}" or not bitrate.isdigit():
+            return None
+        return audio_hash, model, stem, output_format, int(bitrate)
+
+    def lookup(
+        self,
+        audio_hash: str,
+        model: str,
+        output_format=CANONICAL_FORMAT,
+        bitrate=CANONICAL_BITRATE,
+    ):
+        # {stem: path} for a complete entry, None on a miss
+        with connect(self.db_path) as conn:
+            row = conn.execute(
+                "SELECT stems FROM entries WHERE hash = ? AND model = ? AND format = ? AND bitrate = ?",
+                (audio_hash, model, output_format, bitrate),
+            ).fetchone()
+        if row is None:
+            return None
+        paths = {
+            stem: self.stem_path(audio_hash, model, stem, output_format, bitrate)
+            for stem in json.loads(row["stems"])
+        }
+        if not all(os.path.exists(path) for path in paths.values()):
+            self.remove(audio_hash, model, output_format, bitrate)
+            return None
+        self.touch(audio_hash, model)
+        return paths
+
+    def add(
+        self,
+        audio_hash: str,
+        model: str,
+        stems: list,
+        output_format=CANONICAL_FORMAT,
+        bitrate=CANONICAL_BITRATE,
+    ):
+        # called once every stem has been written, so entries are always complete
+        with connect(self.db_path) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (hash, model, format, bitrate, stems, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    audio_hash,
+                    model,
+                    output_format,
+                    bitrate,
+                    json.dumps(list(stems)),
+                    time.time(),
+                ),
+            )
+        self.touch(audio_hash, model)
+
+    def commit(
+        self,
+        staging_dir: str,
+        audio_hash: str,
+        model: str,
+        stems: list,
+        output_format=CANONICAL_FORMAT,
+        bitrate=CANONICAL_BITRATE,
+    ):
+        # moves stems written to staging_dir into place, so that a split that
+        # fails or runs out of disk never leaves partial stems behind
+        stem_dir = self.stem_dir(audio_hash, model, output_format, bitrate)
+        shutil.rmtree(stem_dir, ignore_errors=True)
+        os.rename(staging_dir, stem_dir)
+        self.add(audio_hash, model, stems, output_format, bitrate)
+
+    def remove(
+        self,
+        audio_hash: str,
+        model: str,
+        output_format=CANONICAL_FORMAT,
+        bitrate=CANONICAL_BITRATE,
+    ):
+        with connect(self.db_path) as conn:
+            conn.execute(
+                "DELETE FROM entries WHERE hash = ? AND model = ? AND format = ? AND bitrate = ?",
+                (audio_hash, model, output_format, bitrate),
+            )
+
+    def delete(self, audio_hash: str, model: str):
+        # every variant of the stems of a song for a model, files included
+        with connect(self.db_path) as conn:
+            conn.execute(
+                "DELETE FROM entries WHERE hash = ? AND model = ?", (audio_hash, model)
+            )
+            conn.execute(
+                "DELETE FROM access WHERE hash = ? AND model = ?", (audio_hash, model)
+            )
+        shutil.rmtree(os.path.join(self.root, model, audio_hash), ignore_errors=True)
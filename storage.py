@@ -0,0 +1,240 @@
+import argparse
+import errno
+import os
+import shutil
+
+from catalogue import Catalogue
+from metrics import log_event, metrics
+from stem_store import INPUT_ACCESS, StemStore
+from utils import in_path, out_path
+
+# bytes the inputs, decoded PCM and stems may take together, 0 for no limit
+STORAGE_QUOTA_BYTES = int(os.environ.get("STORAGE_QUOTA_BYTES", 0))
+# bytes to keep free on the volume, 0 to not evict for free space
+STORAGE_MIN_FREE_BYTES = int(os.environ.get("STORAGE_MIN_FREE_BYTES", 0))
+PCM_DIR = "pcm"
+
+
+def dir_size(path: str) -> int:
+    size = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                size += os.stat(os.path.join(dir_path, file_name)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+# keeps the inputs, decoded PCM and stems under a quota by evicting the least
+# recently used first: the stems of a song for a model as a whole, the PCM of
+# a song and input files, the last two by the last access of the song. Songs
+# with queued or running jobs are never evicted
+class StorageManager:
+    def __init__(
+        self,
+        store: StemStore,
+        input_dir=in_path,
+        job_queue=None,
+        quota_bytes=STORAGE_QUOTA_BYTES,
+        min_free_bytes=STORAGE_MIN_FREE_BYTES,
+    ):
+        self.store = store
+        self.input_dir = input_dir
+        self.job_queue = job_queue
+        self.quota_bytes = quota_bytes
+        self.min_free_bytes = min_free_bytes
+        self.catalogue = Catalogue(input_dir, store)
+
+    def items(self) -> list:
+        access = self.store.access_times()
+        items = []
+        with os.scandir(self.store.root) as models:
+            model_dirs = [
+                entry for entry in models if entry.is_dir() and entry.name != PCM_DIR
+            ]
+        for model in model_dirs:
+            with os.scandir(model.path) as songs:
+                for song in songs:
+                    if not song.is_dir():
+                        continue
+                    items.append(
+                        {
+                            "kind": "stems",
+                            "model": model.name,
+                            "hash": song.name,
+                            "path": song.path,
+                            "bytes": dir_size(song.path),
+                            "last_access": access.get(
+                                (song.name, model.name), song.stat().st_mtime
+                            ),
+                        }
+                    )
+        pcm_dir = os.path.join(self.store.root, PCM_DIR)
+        if os.path.isdir(pcm_dir):
+            with os.scandir(pcm_dir) as files:
+                for entry in files:
+                    audio_hash, ext = os.path.splitext(entry.name)
+                    if not entry.is_file() or ext != ".f32":
+                        continue
+                    stat = entry.stat()
+                    items.append(
+                        {
+                            "kind": "pcm",
+                            "hash": audio_hash,
+                            "path": entry.path,
+                            "bytes": stat.st_size,
+                            "last_access": access.get(
+                                (audio_hash, INPUT_ACCESS), stat.st_mtime
+                            ),
+                        }
+                    )
+        with os.scandir(self.input_dir) as files:
+            for entry in files:
+                if not entry.is_file() or entry.name.startswith("."):
+                    continue
+                stat = entry.stat()
+                audio_hash = self.store.cached_hash(entry.path)
+                items.append(
+                    {
+                        "kind": "input",
+                        "hash": audio_hash,
+                        "path": entry.path,
+                        "bytes": stat.st_size,
+                        "last_access": access.get(
+                            (audio_hash, INPUT_ACCESS), stat.st_mtime
+                        ),
+                    }
+                )
+        return items
+
+    def usage(self, items=None) -> dict:
+        # bytes taken by the inputs, the decoded PCM and the stems of each model
+        usage = {"inputs": 0, "pcm": 0, "models": {}}
+        for item in self.items() if items is None else items:
+            if item["kind"] == "stems":
+                models = usage["models"]
+                models[item["model"]] = models.get(item["model"], 0) + item["bytes"]
+            else:
+                usage["inputs" if item["kind"] == "input" else "pcm"] += item["bytes"]
+        usage["total"] = usage["inputs"] + usage["pcm"] + sum(usage["models"].values())
+        return usage
+
+    def in_flight(self):
+        # input files and song hashes of the queued and running jobs
+        file_paths = set()
+        if self.job_queue is not None:
+            file_paths = {
+                os.path.normpath(file_path)
+                for file_path in self.job_queue.active_files()
+            }
+        hashes = set()
+        for file_path in file_paths:
+            try:
+                hashes.add(self.store.hash_song(file_path))
+            except FileNotFoundError:
+                pass
+        return file_paths, hashes
+
+    def make_room(self, needed_bytes=0) -> int:
+        # evicts until needed_bytes more fit under the quota and leave
+        # min_free_bytes free on the volume, returns the bytes freed. Raises
+        # ENOSPC if the volume can't take needed_bytes even so
+        freed = 0
+        if self.quota_bytes or self.min_free_bytes:
+            items = self.items()
+            excess = 0
+            if self.quota_bytes:
+                used = self.usage(items)["total"]
+                excess = used + needed_bytes - self.quota_bytes
+            if self.min_free_bytes:
+                free = shutil.disk_usage(self.store.root).free
+                excess = max(excess, self.min_free_bytes + needed_bytes - free)
+            if excess > 0:
+                file_paths, hashes = self.in_flight()
+                for item in sorted(items, key=lambda item: item["last_access"]):
+                    if freed >= excess:
+                        break
+                    if (
+                        item["hash"] in hashes
+                        or os.path.normpath(item["path"]) in file_paths
+                    ):
+                        continue
+                    self.evict(item)
+                    freed += item["bytes"]
+        if shutil.disk_usage(self.store.root).free < needed_bytes:
+            raise OSError(
+                errno.ENOSPC,
+                f"Not enough disk space for {format_bytes(needed_bytes)}"
+                f" in {self.store.root}",
+            )
+        return freed
+
+    def evict(self, item: dict):
+        if item["kind"] == "stems":
+            self.store.delete(item["hash"], item["model"])
+        else:
+            try:
+                os.remove(item["path"])
+            except FileNotFoundError:
+                pass
+            if item["kind"] == "input":
+                self.catalogue.remove(os.path.basename(item["path"]))
+        metrics.inc("storage_evicted_bytes_total", item["bytes"], kind=item["kind"])
+        log_event(
+            "storage_evicted",
+            kind=item["kind"],
+            model=item.get("model"),
+            hash=item["hash"],
+            path=item["path"],
+            bytes=item["bytes"],
+            last_access=item["last_access"],
+        )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Report the disk usage of the inputs and stems, and evict"
+        " the least recently used ones over the quota."
+    )
+    parser.add_argument("-i", "--input-dir", default=in_path)
+    parser.add_argument("-o", "--output", default=out_path)
+    parser.add_argument("--quota", type=int, default=STORAGE_QUOTA_BYTES)
+    parser.add_argument("--min-free", type=int, default=STORAGE_MIN_FREE_BYTES)
+    parser.add_argument("--evict", action="store_true", help="evict down to the quota")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    # jobs imports this module for its workers
+    from jobs import JOBS_DB_FILE, JobQueue
+
+    args = parse_args(argv)
+    storage = StorageManager(
+        StemStore(args.output),
+        input_dir=args.input_dir,
+        job_queue=JobQueue(os.path.join(args.output, JOBS_DB_FILE)),
+        quota_bytes=args.quota,
+        min_free_bytes=args.min_free,
+    )
+    if args.evict:
+        print(f"Evicted {format_bytes(storage.make_room())}")
+    usage = storage.usage()
+    for model, size in sorted(usage["models"].items()):
+        print(f"{model:>32}  {format_bytes(size):>12}")
+    print(f"{'decoded pcm':>32}  {format_bytes(usage['pcm']):>12}")
+    print(f"{'inputs':>32}  {format_bytes(usage['inputs']):>12}")
+    quota = f" of {format_bytes(args.quota)}" if args.quota else ""
+    print(f"{'total':>32}  {format_bytes(usage['total']):>12}{quota}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,180 +1,221 @@
-import datetime
+import contextlib
+import glob
 import os
-import shlex
+import shutil
 import tarfile
+import threading
+import time
 import urllib.request
 
-import streamlit as st
-import tqdm as tqdm_module
-from demucs.separate import main as demucs_main
+from leases import LEASES_DB, LeaseLock
+from metrics import log_event
+from pcm_cache import CHANNELS, SAMPLERATE, PcmCache
+from preview import PREVIEW_SECONDS, loudest_excerpt, preview_model
+from profiles import DEFAULT_PROFILE, INFERENCE_PROFILES, output_stems, store_model
+from profiling import profile_run
+from stem_store import StemStore
 
 in_path = "./inputs"
 out_path = "./separated/"
-MAX_TIME_LOCK_IN_SECONDS = 1000
 
 
-def timeit(func):
-    def wrapper(*args, **kwargs):
-        import time
-
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        st.write(f"Execution time: {end_time - start_time:.2f} seconds")
-        return result
-
-    return wrapper
-
-
-def call_function_with_streamlit_progress(func, *args, **kwargs):
-    progress_bar = st.progress(0)
-    progress_text = st.empty()
-
-    # Save the real tqdm
-    real_tqdm = tqdm_module.tqdm
-
-    # Fake tqdm
-    class StreamlitTqdm(real_tqdm):
-        def update(self, n=1):
-            super().update(n)
-            if self.total:
-                progress = int((self.n / self.total) * 100)
-                progress_bar.progress(min(progress, 100))
-                elapsed_time = self.format_dict["elapsed"]
-                rate = self.format_dict["rate"]
-                remaining_time = (
-                    (self.total - self.n) / rate if rate and self.total > self.n else 0
+def separate_tracks(
+    file_path: str,
+    output_path: str,
+    ffmpeg_path=None,
+    model="htdemucs",
+    streaming=None,
+    progress=None,
+    profile=DEFAULT_PROFILE,
+    preview=False,
+    excerpt_start=None,
+    stems=None,
+    timings=None,
+    profiling=False,
+    storage=None,
+):
+    if ffmpeg_path:
+        os.environ["PATH"] = f"{ffmpeg_path}:{os.environ['PATH']}"
+    elif find_ffmpeg() is None:
+        install_ffmpeg()
+    store = StemStore(output_path)
+    audio_hash = store.hash_song(file_path)
+    # stems is the subset of the model's stems to write, the others being
+    # written summed as a single residual stem
+    stored_model = store_model(model, profile, stems)
+    if store.lookup(audio_hash, stored_model) is not None:
+        return
+    # a preview is an excerpt of PREVIEW_SECONDS starting at excerpt_start,
+    # or at the loudest part of the song, replaced by the full stems once
+    # they are there
+    full_model = stored_model
+    if preview:
+        stored_model = preview_model(stored_model)
+        if store.lookup(audio_hash, stored_model) is not None:
+            return
+    # one replica computes an output while the others wait for it and reuse
+    # it, so the store is checked again once the lease is held
+    leases = LeaseLock(os.path.join(output_path, LEASES_DB))
+    key = f"{audio_hash}/{stored_model}"
+    with leases.hold(key) as lease_lost:
+        if (
+            store.lookup(audio_hash, full_model) is not None
+            or store.lookup(audio_hash, stored_model) is not None
+        ):
+            return
+        # torch and demucs are only imported once there is something to separate
+        from engine import STREAMING_MIN_DURATION_IN_SECONDS, get_engine
+
+        engine = get_engine()
+        # seconds per stage, filled in as the stages run, so that the caller
+        # gets them even if a stage fails
+        engine.timings = timings if timings is not None else {}
+        # stems are written to a staging directory moved into place once
+        # complete, the profile is saved next to them, see profiling.profile_run
+        staging_dir = store.staging_dir(audio_hash, stored_model)
+        try:
+            with profile_run(staging_dir) if profiling else contextlib.nullcontext():
+                with engine.timed("decode"):
+                    wav = PcmCache(os.path.join(output_path, "pcm")).load(
+                        file_path, audio_hash
+                    )
+                if preview:
+                    start = (
+                        loudest_excerpt(wav)
+                        if excerpt_start is None
+                        else int(excerpt_start * SAMPLERATE)
+                    )
+                    wav = wav[..., start : start + PREVIEW_SECONDS * SAMPLERATE]
+                if storage is not None:
+                    # room for the float32 stems before any of them is written
+                    sources = engine.get_model(
+                        model, INFERENCE_PROFILES[profile]["precision"]
+                    ).sources
+                    storage.make_room(
+                        wav.shape[-1] * CHANNELS * 4 * len(output_stems(sources, stems))
+                    )
+                if streaming is None:
+                    streaming = (
+                        wav.shape[-1] / SAMPLERATE > STREAMING_MIN_DURATION_IN_SECONDS
+                    )
+                separate_to_files = (
+                    engine.separate_to_files_streaming
+                    if streaming
+                    else engine.separate_to_files
                 )
-                progress_text.text(
-                    f"Progress: {progress}% | Elapsed: {elapsed_time:.2f}s | Remaining: {remaining_time:.2f}s"
+                stems = separate_to_files(
+                    wav=wav,
+                    output_dir=staging_dir,
+                    model_name=model,
+                    progress=progress,
+                    profile=profile,
+                    stems=stems,
                 )
-                if self.total == self.n:
-                    progress_bar.empty()
-                    progress_text.empty()
-
+            # another replica may have taken the lease over and be
+            # committing the same stems
+            if lease_lost.is_set():
+                raise RuntimeError(f"Lease on {key} lost")
+            store.commit(staging_dir, audio_hash, stored_model, stems)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        if preview and store.lookup(audio_hash, full_model) is not None:
+            # the full stems were committed while the preview was split
+            store.delete(audio_hash, stored_model)
+    if not preview:
+        # under the preview's lease, as a preview being split is staged in
+        # the directory deleted with it
+        with leases.hold(f"{audio_hash}/{preview_model(full_model)}"):
+            store.delete(audio_hash, preview_model(full_model))
+
+
+# ffmpeg is looked up at FFMPEG_PATH, then on PATH, then in FFMPEG_DIR where
+# it is extracted from FFMPEG_ARCHIVE, the archive being downloaded only if
+# it isn't there already
+FFMPEG_PATH = os.environ.get("FFMPEG_PATH")
+FFMPEG_DIR = "ffmpeg_bin"
+FFMPEG_ARCHIVE = os.environ.get("FFMPEG_ARCHIVE", "ffmpeg.tar.xz")
+FFMPEG_URL = (
+    "https://johnvansickle.com/ffmpeg/releases/ffmpeg-release-amd64-static.tar.xz"
+)
+# seconds before a failed provisioning is tried again
+FFMPEG_RETRY_SECONDS = 300
+
+_ffmpeg_dir = None
+_provisioning = None
+_provisioning_failed_at = None
+_provisioning_lock = threading.Lock()
+
+
+def find_ffmpeg():
+    # directory of the ffmpeg binary, None until there is one. Found once per
+    # process and put on PATH for ffmpeg subprocesses
+    global _ffmpeg_dir
+    if _ffmpeg_dir is None:
+        candidates = [FFMPEG_PATH, shutil.which("ffmpeg")]
+        candidates += sorted(glob.glob(os.path.join(FFMPEG_DIR, "ffmpeg*", "ffmpeg")))
+        for candidate in candidates:
+            if candidate and os.access(candidate, os.X_OK):
+                _ffmpeg_dir = os.path.dirname(os.path.abspath(candidate))
+                if _ffmpeg_dir not in os.environ["PATH"].split(os.pathsep):
+                    os.environ["PATH"] = (
+                        f"{_ffmpeg_dir}{os.pathsep}{os.environ['PATH']}"
+                    )
+                break
+    return _ffmpeg_dir
+
+
+def install_ffmpeg(install_dir=FFMPEG_DIR, archive_path=FFMPEG_ARCHIVE):
+    if find_ffmpeg() is not None:
+        return _ffmpeg_dir
+    tmp_suffix = f"{os.getpid()}.{threading.get_ident()}.tmp"
+    tmp_archive = f"{archive_path}.{tmp_suffix}"
+    # extracted aside and renamed into place, so that a half extracted
+    # binary is never found
+    tmp_dir = f"{install_dir}.{tmp_suffix}"
     try:
-        # Monkey-patch
-        tqdm_module.tqdm = StreamlitTqdm
-        return func(*args, **kwargs)
-
+        if not os.path.exists(archive_path):
+            urllib.request.urlretrieve(FFMPEG_URL, tmp_archive)
+            os.replace(tmp_archive, archive_path)
+        with tarfile.open(archive_path, "r:xz") as tar:
+            tar.extractall(path=tmp_dir)
+        try:
+            os.rename(tmp_dir, install_dir)
+        except OSError:
+            # extracted concurrently by another process
+            pass
     finally:
-        # Restore tqdm
-        tqdm_module.tqdm = real_tqdm
+        # what is left of a failed download or extraction
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_archive)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    for ffmpeg_path in glob.glob(os.path.join(install_dir, "ffmpeg*", "ffmpeg")):
+        os.chmod(ffmpeg_path, 0o755)
+    return find_ffmpeg()
 
 
-@timeit
-def separate_tracks(
-    file_path: str, output_path: str, ffmpeg_path=None, model="htdemucs"
-):
-    opts_str = f'-o {output_path} -n {model} --device cpu --mp3 --mp3-bitrate=192 "{file_path}"'
-
-    opts = shlex.split(opts_str)
-    os.environ["PATH"] = (
-        f"{ffmpeg_path}:{os.environ['PATH']}" if ffmpeg_path else os.environ["PATH"]
-    )
-    call_function_with_streamlit_progress(demucs_main, opts)
-
-
-def install_ffmpeg_from_url(install_dir="ffmpeg_bin"):
-    if os.path.exists("ffmpeg_bin/ffmpeg-7.0.2-amd64-static"):
-        return "ffmpeg_bin/ffmpeg-7.0.2-amd64-static/ffmpeg"
-    url = "https://johnvansickle.com/ffmpeg/releases/ffmpeg-release-amd64-static.tar.xz"
-    tar_path = "ffmpeg.tar.xz"
-
-    # Create install dir
-    os.makedirs(install_dir, exist_ok=True)
-
-    # Download the file
-    urllib.request.urlretrieve(url, tar_path)
-
-    # Extract the archive
-    with tarfile.open(tar_path, "r:xz") as tar:
-        tar.extractall(path=install_dir)
-
-    # Find the ffmpeg binary inside the extracted folder
-    extracted_dir = next(
-        os.path.join(install_dir, d)
-        for d in os.listdir(install_dir)
-        if d.startswith("ffmpeg")
-    )
-    ffmpeg_path = os.path.join(extracted_dir, "ffmpeg")
-
-    # Make executable
-    os.chmod(ffmpeg_path, 0o755)
-    # Move ffmpeg to the PATH
-    os.environ["PATH"] = f"{os.path.dirname(ffmpeg_path)}:{os.environ['PATH']}"
-
-    return ffmpeg_path
-
-
-def get_file_path(song: str, stem: str, model: str) -> str:
-    if song.endswith(".mp3"):
-        song = song[:-4]
-    return f"{out_path}/{model}/{song}/{stem}.mp3"
-
-
-def download_from_yt(url: str, input_dir: str) -> str:
-    import yt_dlp
-
-    # if https://youtu.be/GLvohMXgcBo?si=1RLd6Dc6Yxz-4Yb5
-    # then url = https://www.youtube.com/watch?v=GLvohMXgcBo&si=1RLd6Dc6Yxz-4Yb5
-    if "youtu.be" in url:
-        video = url.split("/")[-1].split("?")[0]
-        url = f"https://www.youtube.com/watch?v={video}"
-
-    ydl_opts = {
-        "format": "bestaudio/best",
-        "postprocessors": [
-            {
-                "key": "FFmpegExtractAudio",
-                "preferredcodec": "mp3",
-                "preferredquality": "192",
-            }
-        ],
-        "outtmpl": f"{input_dir}/%(title)s.%(ext)s",
-        "http_headers": {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-        },
-    }
-
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
-        original_file = ydl.prepare_filename(info)
-        # Replace extension with .mp3
-        mp3_file = os.path.basename(os.path.splitext(original_file)[0] + ".mp3")
-        return mp3_file
-
-
-def lock_file():
-    # creates a lock file with the current time
-    now = datetime.datetime.now()
-    with open("/tmp/lock", "w") as f:
-        f.write(now.isoformat())
-
-
-def lock_remove():
-    # removes the lock file if it exists
-    if os.path.exists("/tmp/lock"):
-        os.remove("/tmp/lock")
-
-
-def lock_exists(max_time_lock_in_seconds=MAX_TIME_LOCK_IN_SECONDS):
-    # checks if the lock file exists and when it was created
-    now = datetime.datetime.now()
-    if os.path.exists("/tmp/lock"):
-        with open("/tmp/lock", "r") as f:
-            try:
-                created_time = datetime.datetime.fromisoformat(f.read().strip())
-            except ValueError:
-                lock_remove()
-                return False
-        if (now - created_time).total_seconds() > max_time_lock_in_seconds:
-            lock_remove()
-            return False
-        else:
-            return True
-    else:
-        return False
+def _provision():
+    global _provisioning_failed_at
+    try:
+        if install_ffmpeg() is None:
+            raise FileNotFoundError(f"No ffmpeg binary in {FFMPEG_ARCHIVE}")
+    except Exception as e:
+        _provisioning_failed_at = time.monotonic()
+        log_event("ffmpeg_install_failed", error=repr(e), url=FFMPEG_URL)
+
+
+def provision_ffmpeg():
+    # installs ffmpeg in a background thread, once per process, or again
+    # FFMPEG_RETRY_SECONDS after a failed attempt
+    global _provisioning
+    with _provisioning_lock:
+        if _provisioning is None or (
+            not _provisioning.is_alive()
+            and find_ffmpeg() is None
+            and time.monotonic() - _provisioning_failed_at >= FFMPEG_RETRY_SECONDS
+        ):
+            _provisioning = threading.Thread(target=_provision, daemon=True)
+            _provisioning.start()
+    return _provisioning
 
 
 def read_version():